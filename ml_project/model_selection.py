@@ -1,25 +1,33 @@
 from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import ParameterGrid, check_cv, cross_val_score
+from sklearn.base import BaseEstimator, clone, is_classifier
+from sklearn.utils import check_random_state
+import numpy as np
 import pandas as pd
 from os.path import normpath
+import tempfile
+import shutil
 
 
 class GridSearchCV(GridSearchCV):
-    """docstring for GridSearchCV"""
+    """docstring for GridSearchCV
+
+    With cache_steps the fitted transformers of a Pipeline estimator are
+    cached in a temporary folder during fit, so steps whose params do not
+    change between candidates are fitted once per CV fold.
+    """
     def __init__(self, est_class, est_params, param_grid, cv=None, n_jobs=1,
-                 error_score="raise", save_path=None, **kwargs):
+                 error_score="raise", save_path=None, cache_steps=True,
+                 **kwargs):
         self.est_class = est_class
         self.est_params = est_params
         self.param_grid = param_grid
         self.n_jobs = n_jobs
+        self.cache_steps = cache_steps
         self.estimator = est_class(est_params)
         self.set_save_path(save_path)
         self.cv = cv
-        if cv is not None and type(cv) is not int:
-            self.cv_obj = cv["class"](**cv["params"])
-        elif type(cv) is int:
-            self.cv_obj = cv
-        else:
-            self.cv_obj = None
+        self.cv_obj = _load_cv(cv)
         super(GridSearchCV, self).__init__(self.estimator, param_grid,
                                            cv=self.cv_obj,
                                            n_jobs=n_jobs,
@@ -28,7 +36,19 @@ class GridSearchCV(GridSearchCV):
                                            **kwargs)
 
     def fit(self, X, y=None, groups=None, **fit_params):
-        super(GridSearchCV, self).fit(X, y, groups, **fit_params)
+        if (self.cache_steps and
+                "memory" in self.estimator.get_params(deep=False)):
+            folder = tempfile.mkdtemp()
+            self.estimator.set_params(memory=folder)
+            try:
+                super(GridSearchCV, self).fit(X, y, groups, **fit_params)
+            finally:
+                self.estimator.set_params(memory=None)
+                if hasattr(self, "best_estimator_"):
+                    self.best_estimator_.set_params(memory=None)
+                shutil.rmtree(folder, ignore_errors=True)
+        else:
+            super(GridSearchCV, self).fit(X, y, groups, **fit_params)
 
         if self.save_path is not None:
             data = {
@@ -49,3 +69,161 @@ class GridSearchCV(GridSearchCV):
         if (hasattr(self, "best_estimator_") and
            hasattr(self.best_estimator_, "save_path")):
             self.best_estimator_.set_save_path(save_path)
+
+
+class SuccessiveHalvingSearchCV(BaseEstimator):
+    """Successive halving over param_grid
+
+    Configured like GridSearchCV (est_class, est_params, param_grid, cv).
+    All candidates are cross validated with a small budget, the best
+    1/factor of them go on to the next round with factor times the
+    budget, until one round is run with max_resource.
+
+    resource is "n_samples" (candidates are trained on a random subset of
+    the samples) or the name of an estimator param, e.g.
+    "NeuralNetClassifier__num_epoch" for a Pipeline or "num_epoch".
+    max_resource defaults to the number of samples or to the value of the
+    param; min_resource to max_resource / factor**(n_rounds - 1).
+    """
+    def __init__(self, est_class, est_params, param_grid, cv=None,
+                 resource="n_samples", factor=3, min_resource=None,
+                 max_resource=None, n_jobs=1, random_state=None,
+                 save_path=None):
+        self.est_class = est_class
+        self.est_params = est_params
+        self.param_grid = param_grid
+        self.cv = cv
+        self.resource = resource
+        self.factor = factor
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.estimator = est_class(est_params)
+        self.cv_obj = _load_cv(cv)
+        self.set_save_path(save_path)
+
+    def fit(self, X, y=None, groups=None):
+        candidates = list(ParameterGrid(self.param_grid))
+
+        if self.resource == "n_samples":
+            max_resource = self.max_resource or len(X)
+            # nested random subsets of the samples
+            order = check_random_state(self.random_state).permutation(
+                len(X))
+        else:
+            max_resource = (self.max_resource or
+                            self.estimator.get_params()[self.resource])
+            order = None
+
+        # rounds needed to get down to one candidate
+        n_rounds = 1
+        while self.factor ** n_rounds <= len(candidates):
+            n_rounds += 1
+
+        min_resource = self.min_resource or max(
+            max_resource // self.factor ** (n_rounds - 1), 1)
+
+        results = {"iter": [], "n_resources": [], "params": [],
+                   "mean_test_score": [], "std_test_score": []}
+
+        for i in range(n_rounds):
+            n_resources = min(min_resource * self.factor ** i, max_resource)
+            if i == n_rounds - 1:
+                n_resources = max_resource
+
+            print("------------------------------------")
+            print("SuccessiveHalvingSearchCV round {}: {} candidates, "
+                  "{} = {}".format(i, len(candidates), self.resource,
+                                   n_resources))
+
+            scores = []
+            for params in candidates:
+                score = self._cross_val_score(X, y, groups, params,
+                                              n_resources, order)
+                scores.append(score)
+
+                results["iter"].append(i)
+                results["n_resources"].append(n_resources)
+                results["params"].append(params)
+                results["mean_test_score"].append(np.mean(score))
+                results["std_test_score"].append(np.std(score))
+
+            # keep the best 1/factor candidates
+            ranking = np.argsort([-np.mean(score) for score in scores],
+                                 kind="mergesort")
+            n_keep = max(int(np.ceil(len(candidates) / self.factor)), 1)
+            if i == n_rounds - 1:
+                n_keep = 1
+            candidates = [candidates[index] for index in ranking[:n_keep]]
+            best_score = np.mean(scores[ranking[0]])
+
+        self.cv_results_ = results
+        self.best_params_ = candidates[0]
+        self.best_score_ = best_score
+
+        # refit the best candidate with the full budget
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_)
+        if self.resource != "n_samples":
+            self.best_estimator_.set_params(**{self.resource: max_resource})
+        self.best_estimator_.fit(X, y)
+
+        if self.save_path is not None:
+            data = {
+                "best_params_": self.best_params_,
+                "iter": self.cv_results_["iter"],
+                "n_resources": self.cv_results_["n_resources"],
+                "params": self.cv_results_["params"],
+                "mean_test_score": self.cv_results_["mean_test_score"],
+                "std_test_score": self.cv_results_["std_test_score"],
+            }
+            df = pd.DataFrame.from_dict(pd.io.json.json_normalize(data))
+            df.to_csv(normpath(self.save_path +
+                               "SuccessiveHalvingSearchCV.csv"))
+
+            if hasattr(self.best_estimator_, "save_path"):
+                self.best_estimator_.set_save_path(self.save_path)
+
+        return self
+
+    def _cross_val_score(self, X, y, groups, params, n_resources, order):
+        estimator = clone(self.estimator).set_params(**params)
+
+        if order is None:
+            estimator.set_params(**{self.resource: n_resources})
+        else:
+            subset = np.sort(order[:n_resources])
+            X, y = X[subset], y[subset]
+            if groups is not None:
+                groups = groups[subset]
+
+        cv = check_cv(self.cv_obj, y, classifier=is_classifier(estimator))
+        return cross_val_score(estimator, X, y, groups=groups, cv=cv,
+                               n_jobs=self.n_jobs)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def transform(self, X):
+        return self.best_estimator_.transform(X)
+
+    def score(self, X, y=None):
+        return self.best_estimator_.score(X, y)
+
+    def set_save_path(self, save_path):
+        self.save_path = save_path
+        if (hasattr(self, "best_estimator_") and
+           hasattr(self.best_estimator_, "save_path")):
+            self.best_estimator_.set_save_path(save_path)
+
+
+def _load_cv(cv):
+    """cv object from its config (a class/params dict or an int)"""
+    if cv is not None and type(cv) is not int:
+        return cv["class"](**cv["params"])
+    else:
+        return cv
@@ -7,12 +7,14 @@ from sklearn.metrics import f1_score
 from sklearn.preprocessing import LabelBinarizer
 from sklearn.utils.class_weight import compute_sample_weight, \
     compute_class_weight
-from scipy.stats import spearmanr
 from datetime import datetime
+import time
 from pathlib import Path
 from keras.models import Sequential, load_model
-from keras.layers import Dense, LSTM
+from keras.layers import Dense, LSTM, Masking
+from keras.callbacks import EarlyStopping, ModelCheckpoint
 from keras.preprocessing import sequence
+from ml_project.models import utils
 
 
 class MeanPredictor(BaseEstimator, TransformerMixin):
@@ -49,14 +51,7 @@ class LogisticRegression(LogisticRegression):
 
     def score(self, X, y, sample_weight=None):
         P_predicted = self.predict_proba(X)
-        n_samples, n_labels = np.shape(P_predicted)
-
-        score = np.zeros(n_samples)
-
-        for i in range(0, n_samples):
-            score[i] = spearmanr(y[i, :], P_predicted[i, :])[0]
-
-        return np.mean(score)
+        return np.mean(utils.spearman_rows(y, P_predicted))
 
     def predict_proba(self, X):
         return super(LogisticRegression, self) \
@@ -128,14 +123,7 @@ class LogisticRegressionWithProbability(BaseEstimator, TransformerMixin):
 
     def score(self, X, y, sample_weight=None):
         P_predicted = self.predict_proba(X)
-        n_samples, n_labels = np.shape(P_predicted)
-
-        score = np.zeros(n_samples)
-
-        for i in range(0, n_samples):
-            score[i] = spearmanr(y[i, :], P_predicted[i, :])[0]
-
-        return np.mean(score)
+        return np.mean(utils.spearman_rows(y, P_predicted))
 
     def predict_proba(self, X):
         # parameters
@@ -155,17 +143,66 @@ class LogisticRegressionWithProbability(BaseEstimator, TransformerMixin):
         return P_predicted
 
 
-class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
-    """Convolutional Neural Net Classifier"""
+class InferenceSessionMixin:
+    """Mixin for TensorFlow classifiers which predict from a checkpoint
+
+    _inference_session restores the fitted network from model_path in
+    its own graph and session on the first call only; later calls reuse
+    it until _close_inference (on refit). The graph is built by the
+    class's _inference_graph(X), which returns the input, is_training
+    and output tensors. The session is not pickled.
+    """
+    def _inference_session(self, X):
+        if getattr(self, "_inference", None) is None:
+            graph = tf.Graph()
+            with graph.as_default():
+                X_tf, is_training_tf, output_tf = self._inference_graph(X)
+                saver = tf.train.Saver()
+
+            sess = tf.Session(graph=graph)
+            saver.restore(sess, self.model_path)
+            print("fitted model restored: {}".format(self.model_path))
+
+            self._inference = (sess, X_tf, is_training_tf, output_tf)
+
+        return self._inference
+
+    def _close_inference(self):
+        if getattr(self, "_inference", None) is not None:
+            self._inference[0].close()
+        self._inference = None
+
+    def __getstate__(self):
+        # the session is not picklable, it is restored again when needed
+        state = super(InferenceSessionMixin, self).__getstate__().copy()
+        state["_inference"] = None
+        return state
+
+
+class ConvolutionalNeuralNetClassifier(InferenceSessionMixin, BaseEstimator,
+                                       TransformerMixin):
+    """Convolutional Neural Net Classifier
+
+    The held-out samples are evaluated every eval_every training steps, or
+    once per epoch if eval_every is None, on a fixed random subset of
+    eval_size samples (all if None). train_score=False skips the f1 score
+    of every training batch.
+    """
     def __init__(self,
-                 batch_size=128, dropout=False, dropout_rate=0.1,
+                 batch_size=128, predict_batch_size=1024,
+                 dropout=False, dropout_rate=0.1,
                  optimizer='Adam', learning_rate=0.0001, num_epoch=30,
+                 eval_every=None, eval_size=None, train_score=True,
                  save_path=None, verbosity=1):
 
         self.dropout = dropout
         self.dropout_rate = dropout_rate
-        self.num_epochs = num_epoch
+        self.num_epoch = num_epoch
         self.batch_size = batch_size
+        self.predict_batch_size = predict_batch_size
+        self.eval_every = eval_every
+        self.eval_size = eval_size
+        self.train_score = train_score
         self.optimizer = optimizer
         self.learning_rate = learning_rate
         self.verbosity = verbosity
@@ -179,22 +216,32 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
         self.training_mask = None
         self.evaluation_mask = None
 
+        # inference session, restored once after fit (see predict)
+        self._inference = None
+
         # exceptions
         if optimizer != "Adam" and optimizer != "GradientDescent":
             assert "invalid optimizer"
 
-    def model(self, X_train):
+    def model(self, X_train, inputs=None):
         print("model")
         n_samples, n_features = np.shape(X_train)
 
-        tf.reset_default_graph()
-
-        # input
-        X_tf = tf.placeholder(tf.float32,
-                              shape=[None, n_features],
-                              name='X')
-        y_tf = tf.placeholder(tf.float32,
-                              name='y')
+        # input (fed, or by default the batches of an input pipeline)
+        if inputs is None:
+            X_tf = tf.placeholder(tf.float32,
+                                  shape=[None, n_features],
+                                  name='X')
+            y_tf = tf.placeholder(tf.float32,
+                                  name='y')
+        else:
+            X_batch, y_batch = inputs
+            X_tf = tf.placeholder_with_default(X_batch,
+                                               shape=[None, n_features],
+                                               name='X')
+            y_tf = tf.placeholder_with_default(y_batch,
+                                               shape=[None],
+                                               name='y')
         is_training_tf = tf.placeholder(tf.bool,
                                         name='is_training')
 
@@ -341,36 +388,6 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
             train_loss_summary, eval_loss_summary, train_score_summary, \
             eval_score_summary
 
-    def random_batches(self, X_train, y_train):
-
-        print("         generate batch")
-
-        # size
-        n_samples, _ = np.shape(X_train)
-        batch_size = self.batch_size
-
-        # batchs
-        batches = []
-
-        random_mask = list(np.random.permutation(n_samples))
-        random_X = X_train[random_mask, :]
-        random_Y = y_train[random_mask]
-
-        num_batches = n_samples // batch_size
-        for i in range(0, num_batches):
-            batch_X = random_X[batch_size * i:batch_size * i + batch_size, :]
-            batch_Y = random_Y[batch_size * i:batch_size * i + batch_size]
-            batch = (batch_X, batch_Y)
-            batches.append(batch)
-
-        if n_samples % batch_size != 0:
-            batch_X = random_X[num_batches * batch_size:n_samples, :]
-            batch_Y = random_Y[num_batches * batch_size:n_samples]
-            batch = (batch_X, batch_Y)
-            batches.append(batch)
-
-        return batches
-
     def fit(self, X, y, sample_weight=None):
 
         print("------------------------------------")
@@ -382,15 +399,44 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
         mask = list(np.random.permutation(n_samples))
         self.training_mask = mask[0:6000]
         self.evaluation_mask = mask[6000:None]
-        X_eval = X[self.evaluation_mask, :]
-        y_eval = y[self.evaluation_mask]
+        X_train = X[self.training_mask, :]
+        y_train = y[self.training_mask]
+
+        # evaluation on a fixed subset of the held-out samples
+        if (self.eval_size is not None and
+                self.eval_size < len(self.evaluation_mask)):
+            eval_mask = self.random_state.choice(self.evaluation_mask,
+                                                 self.eval_size,
+                                                 replace=False)
+        else:
+            eval_mask = self.evaluation_mask
+        X_eval = X[eval_mask, :]
+        y_eval = y[eval_mask]
+
+        # the inference session of a previous fit is stale
+        self._close_inference()
 
         # build network
+        tf.reset_default_graph()
+        batch_X, batch_y, batches_init, data_init = _input_pipeline(
+            X_train, y_train, self.batch_size, tf.float32)
         (
             X_tf, y_tf, is_training_tf, train_score_tf, eval_score_tf, logits,
             probs_tf, prediction_tf, loss_tf, train_op, train_loss_summary,
             eval_loss_summary, train_score_summary, eval_score_summary)\
-            = self.model(X[self.training_mask, :])
+            = self.model(X_train, inputs=(batch_X, batch_y))
+
+        # tensors for the evaluation
+        evaluation = {
+            "X": X_tf,
+            "y": y_tf,
+            "is_training": is_training_tf,
+            "loss": loss_tf,
+            "prediction": prediction_tf,
+            "loss_summary": eval_loss_summary,
+            "score": eval_score_tf,
+            "score_summary": eval_score_summary
+        }
 
         # initialization operation
         init_op = tf.global_variables_initializer()
@@ -406,6 +452,7 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
             # initialization run
             print("     initialization")
             sess.run(init_op)
+            sess.run(data_init[0], feed_dict=data_init[1])
 
             # training
             print("     training")
@@ -413,75 +460,68 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
             # step
             step = 0
 
-            for epoch in range(self.num_epochs):
+            for epoch in range(self.num_epoch):
 
                 # =============================================================
-                # training with batch
-                batches = self.random_batches(X_train=X[self.training_mask, :],
-                                              y_train=y[self.training_mask])
+                # training with batch (reshuffled every epoch)
+                sess.run(batches_init)
+                epoch_start = time.time()
 
-                for (batch_X, batch_y) in batches:
+                while True:
 
                     # training
                     feed_train = {
-                        X_tf: batch_X,
-                        y_tf: batch_y.astype('float32'),
                         is_training_tf: True
                     }
 
-                    _, loss_train, prediction_train, train_loss_summ = \
-                        sess.run([train_op, loss_tf, prediction_tf,
-                                  train_loss_summary],
-                                 feed_dict=feed_train)
-
-                    # training score
-                    score_train = f1_score(batch_y,
-                                           prediction_train,
-                                           average="micro")
-                    train_score_summ = sess.run(train_score_summary,
-                                                feed_dict={
-                                                    train_score_tf:
-                                                        score_train})
+                    try:
+                        _, loss_train, prediction_train, train_loss_summ, \
+                            batch_y = sess.run([train_op, loss_tf,
+                                                prediction_tf,
+                                                train_loss_summary, y_tf],
+                                               feed_dict=feed_train)
+                    except tf.errors.OutOfRangeError:
+                        break
 
                     summary_writer.add_summary(train_loss_summ, step)
-                    summary_writer.add_summary(train_score_summ, step)
-
-                    # evaluation
-                    feed_eval = {
-                        X_tf: X_eval,
-                        y_tf: y_eval.astype('float32'),
-                        is_training_tf: False
-                    }
-
-                    loss_eval, prediction_eval, eval_loss_summ = \
-                        sess.run([loss_tf, prediction_tf, eval_loss_summary],
-                                 feed_dict=feed_eval)
 
-                    # evaluation score
-                    score_eval = f1_score(y_eval,
-                                          prediction_eval,
-                                          average="micro")
-                    eval_score_summ = sess.run(eval_score_summary,
-                                               feed_dict={
-                                                   eval_score_tf: score_eval})
-
-                    summary_writer.add_summary(eval_loss_summ, step)
-                    summary_writer.add_summary(eval_score_summ, step)
+                    # training score
+                    if self.train_score:
+                        score_train = f1_score(batch_y,
+                                               prediction_train,
+                                               average="micro")
+                        train_score_summ = sess.run(train_score_summary,
+                                                    feed_dict={
+                                                        train_score_tf:
+                                                            score_train})
+                        summary_writer.add_summary(train_score_summ, step)
+                    else:
+                        score_train = None
 
-                    # log and tensorboard
+                    # log
                     print("         epoch = {} (step = {})/ "
                           "loss train   = {} / "
-                          "f1 train     = {} / "
-                          "loss eval    = {} / "
-                          "f1 eval      = {}".format(epoch, step,
+                          "f1 train     = {}".format(epoch, step,
                                                      loss_train,
-                                                     score_train,
-                                                     loss_eval,
-                                                     score_eval))
+                                                     score_train))
+
+                    # evaluation every eval_every steps
+                    if (self.eval_every is not None and
+                            step % self.eval_every == 0):
+                        self._evaluate(sess, evaluation, summary_writer,
+                                       X_eval, y_eval, epoch, step)
 
                     # step
                     step = step + 1
 
+                print("     epoch {}: {:.1f} samples/sec".format(
+                    epoch, len(X_train) / (time.time() - epoch_start)))
+
+                # evaluation once per epoch
+                if self.eval_every is None:
+                    self._evaluate(sess, evaluation, summary_writer,
+                                   X_eval, y_eval, epoch, step - 1)
+
             # close summary writer
             summary_writer.close()
 
@@ -507,30 +547,73 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
 
         return self
 
+    def _evaluate(self, sess, evaluation, summary_writer, X_eval, y_eval,
+                  epoch, step):
+        """Loss and f1 score of the held-out samples, in batches"""
+        n_eval = len(X_eval)
+        loss_eval = 0.0
+        prediction_eval = np.empty(n_eval, dtype=np.int64)
+
+        for start in range(0, n_eval, self.predict_batch_size):
+            stop = min(start + self.predict_batch_size, n_eval)
+
+            feed_eval = {
+                evaluation["X"]: X_eval[start:stop],
+                evaluation["y"]: y_eval[start:stop].astype('float32'),
+                evaluation["is_training"]: False
+            }
+
+            loss_batch, prediction_eval[start:stop] = \
+                sess.run([evaluation["loss"], evaluation["prediction"]],
+                         feed_dict=feed_eval)
+            loss_eval += loss_batch * (stop - start)
+
+        loss_eval /= n_eval
+
+        # evaluation score
+        score_eval = f1_score(y_eval,
+                              prediction_eval,
+                              average="micro")
+
+        # tensorboard (the loss summary is fed the mean over the batches)
+        eval_loss_summ, eval_score_summ = sess.run(
+            [evaluation["loss_summary"], evaluation["score_summary"]],
+            feed_dict={evaluation["loss"]: loss_eval,
+                       evaluation["score"]: score_eval})
+
+        summary_writer.add_summary(eval_loss_summ, step)
+        summary_writer.add_summary(eval_score_summ, step)
+
+        print("         epoch = {} (step = {})/ "
+              "loss eval    = {} / "
+              "f1 eval      = {}".format(epoch, step,
+                                         loss_eval,
+                                         score_eval))
+
     def predict(self, X):
         print("------------------------------------")
         print("CNNClassifier predict")
 
-        # build neural net
-        X_tf, _, is_training_tf, _, _, _, _, predictions_tf, _, _, _, _, _, _ \
-            = self.model(X)
+        # batches of predict_batch_size rows bound the memory of the
+        # convolution activations
+        return utils.predict_batches(self._predict_batch, X,
+                                     self.predict_batch_size)
 
-        # tensorflow seesion
-        saver = tf.train.Saver()
+    def _predict_batch(self, X):
+        sess, X_tf, is_training_tf, predictions_tf = \
+            self._inference_session(X)
 
-        with tf.Session() as sess:
-            save_path = self.model_path
-            saver.restore(sess, save_path)
-            print("fitted model restored: {}".format(save_path))
+        feed = {
+            X_tf: X,
+            is_training_tf: False
+        }
 
-            feed = {
-                X_tf: X,
-                is_training_tf: False
-            }
+        return sess.run(predictions_tf, feed_dict=feed)
 
-            prediction = sess.run(predictions_tf, feed_dict=feed)
-
-        return prediction
+    def _inference_graph(self, X):
+        X_tf, _, is_training_tf, _, _, _, _, predictions_tf, \
+            _, _, _, _, _, _ = self.model(X)
+        return X_tf, is_training_tf, predictions_tf
 
     def score(self, X, y, sample_weight=None):
         y_predicted = self.predict(X)
@@ -544,10 +627,25 @@ class ConvolutionalNeuralNetClassifier(BaseEstimator, TransformerMixin):
 
 
 class LSTMClassifier(BaseEstimator, TransformerMixin):
-    """LSTM Classifier for sequential data"""
+    """LSTM Classifier for sequential data
+
+    With validation_split > 0 that fraction of the (shuffled) samples is
+    held out, training stops once monitor has not improved for patience
+    epochs and model.h5 holds the best epoch's model.
+
+    With n_buckets the sequences (up to their last non-zero value) are
+    grouped into that many length buckets, set by the quantiles of the
+    training lengths. Every batch holds sequences of one bucket, padded
+    only to the bucket length with PAD_VALUE, which a Masking layer skips.
+    """
+    # padding of the length buckets, a value no sample takes (zeros are
+    # valid samples and must not be masked)
+    PAD_VALUE = -np.finfo(np.float32).max
+
     def __init__(self, dropout_rate=0.3, save_path=None, lstm_layers=None,
                  batch_size=100, num_epoch=300, max_len=500, n_feature=1,
-                 optimizer='adam'):
+                 optimizer='adam', validation_split=0.1, monitor='val_loss',
+                 patience=10, n_buckets=None):
 
         self.dropout_rate = dropout_rate
         self.lstm_layers = lstm_layers
@@ -557,10 +655,17 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         self.max_len = max_len
         self.n_feature = n_feature
         self.optimizer = optimizer
+        self.validation_split = validation_split
+        self.monitor = monitor
+        self.patience = patience
+        self.n_buckets = n_buckets
 
         self.model_name = datetime.now().strftime('model_%Y%m%d-%H%M%S')
         self.model_path = None
 
+        # network loaded from model_path, once (see predict_proba)
+        self._net = None
+
         # network structure
         if lstm_layers is None:
             self.lstm_layers = [8]
@@ -570,6 +675,11 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         # model
         model = Sequential()
 
+        # padding of the length buckets (any length)
+        if self.n_buckets:
+            model.add(Masking(mask_value=self.PAD_VALUE,
+                              input_shape=(None, n_feature)))
+
         # lstm
         for i, lstm_layer in enumerate(self.lstm_layers):
             if i is 0 and i is len(self.lstm_layers) - 1:
@@ -608,16 +718,34 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         print("------------------------------------")
         print("LSTMClassifier fit")
 
-        # truncate X
-        X = sequence.pad_sequences(
-            X, maxlen=self.max_len * self.n_feature, truncating="post")
+        # the network loaded for a previous fit is stale
+        self._net = None
+
+        if self.n_buckets:
+            # length buckets, from the quantiles of the training lengths
+            timesteps = self._timesteps(X)
+            self.bucket_timesteps_ = np.unique(np.append(
+                np.percentile(timesteps,
+                              np.linspace(0, 100, self.n_buckets + 1)[1:],
+                              interpolation="higher").astype(int),
+                self.max_len))
+            buckets = np.searchsorted(self.bucket_timesteps_, timesteps)
+
+            print("bucket time steps = {}".format(self.bucket_timesteps_))
+            print("bucket sizes = {}".format(np.bincount(buckets)))
+        else:
+            # truncate X
+            X = sequence.pad_sequences(
+                X, maxlen=self.max_len * self.n_feature, truncating="post")
+
         n_samples, n_timestep = np.shape(X)
 
-        # kth order (feature)
-        timestep = int(n_timestep / self.n_feature)
-        X = np.reshape(X, (n_samples, timestep, self.n_feature))
+        if not self.n_buckets:
+            # kth order (feature)
+            timestep = int(n_timestep / self.n_feature)
+            X = np.reshape(X, (n_samples, timestep, self.n_feature))
 
-        print("input shape = {}".format(np.shape(X)))
+            print("input shape = {}".format(np.shape(X)))
 
         # class weight (for imbalance data)
         sample_weight = compute_sample_weight('balanced', y)
@@ -627,16 +755,6 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         one_hot_encoder.fit(y)
         y = one_hot_encoder.transform(y)
 
-        # model
-        # network
-        net = self.model(timestep, self.n_feature)
-        net.fit(X.astype(float), y,
-                epochs=self.num_epoch,
-                batch_size=self.batch_size,
-                # callbacks=callback,
-                sample_weight=sample_weight,
-                verbose=2)
-
         # model path
         if self.save_path is None:
             self.save_path = 'data/tmp/'
@@ -650,8 +768,62 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         self.model_path = \
             self.save_path + self.model_name + '/model.h5'
 
-        # save model
-        net.save(self.model_path)
+        # early stopping, keeping the best model (keras holds out the
+        # last samples, so shuffle first)
+        if self.validation_split > 0:
+            shuffle = np.random.permutation(n_samples)
+            X, y, sample_weight = \
+                X[shuffle], y[shuffle], sample_weight[shuffle]
+            if self.n_buckets:
+                buckets = buckets[shuffle]
+
+            callbacks = [
+                EarlyStopping(monitor=self.monitor, patience=self.patience,
+                              verbose=1),
+                ModelCheckpoint(self.model_path, monitor=self.monitor,
+                                save_best_only=True, verbose=1)]
+        else:
+            callbacks = None
+
+        # model
+        # network
+        if self.n_buckets:
+            net = self.model(None, self.n_feature)
+
+            # held out samples as keras' validation_split would take them
+            n_train = n_samples - int(n_samples * self.validation_split)
+            train, val = slice(0, n_train), slice(n_train, None)
+
+            if n_train < n_samples:
+                validation_data = self._bucket_batches(
+                    X[val], y[val], sample_weight[val], buckets[val],
+                    shuffle=False)
+                validation_steps = self._n_batches(buckets[val])
+            else:
+                validation_data, validation_steps = None, None
+
+            net.fit_generator(
+                self._bucket_batches(X[train], y[train],
+                                     sample_weight[train], buckets[train]),
+                steps_per_epoch=self._n_batches(buckets[train]),
+                epochs=self.num_epoch,
+                validation_data=validation_data,
+                validation_steps=validation_steps,
+                callbacks=callbacks,
+                verbose=2)
+        else:
+            net = self.model(timestep, self.n_feature)
+            net.fit(X.astype(float), y,
+                    epochs=self.num_epoch,
+                    batch_size=self.batch_size,
+                    validation_split=self.validation_split,
+                    callbacks=callbacks,
+                    sample_weight=sample_weight,
+                    verbose=2)
+
+        # save model (the checkpoint already holds the best one)
+        if callbacks is None:
+            net.save(self.model_path)
         print("fitted model save: {}".format(self.model_path))
         del net
 
@@ -661,8 +833,26 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         print("------------------------------------")
         print("LSTMClassifier predict_proba")
 
-        # load model
-        net = load_model(self.model_path)
+        net = self._network()
+
+        if self.n_buckets:
+            # predict bucket by bucket, each padded to its own length
+            buckets = np.searchsorted(self.bucket_timesteps_,
+                                      self._timesteps(X))
+
+            P_predicted = None
+            for bucket in np.unique(buckets):
+                index = np.flatnonzero(buckets == bucket)
+                P_bucket = net.predict(
+                    self._bucket_sequences(X[index],
+                                           self.bucket_timesteps_[bucket]),
+                    batch_size=self.batch_size)
+
+                if P_predicted is None:
+                    P_predicted = np.empty((len(X), P_bucket.shape[1]))
+                P_predicted[index] = P_bucket
+
+            return P_predicted
 
         # truncate X
         X = sequence.pad_sequences(X, maxlen=self.max_len * self.n_feature,
@@ -675,6 +865,79 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
 
         return net.predict(X.astype(float))
 
+    def _network(self):
+        """Fitted network, loaded from model_path on first use only"""
+        if getattr(self, "_net", None) is None:
+            self._net = load_model(self.model_path)
+            print("fitted model loaded: {}".format(self.model_path))
+
+        return self._net
+
+    def __getstate__(self):
+        # keep pickles small, the network is loaded again when needed
+        state = super(LSTMClassifier, self).__getstate__().copy()
+        state["_net"] = None
+        return state
+
+    def _timesteps(self, X):
+        """Time steps of every sequence up to its last non-zero value
+
+        At least 1 and at most max_len.
+        """
+        nonzero = np.asarray(X) != 0
+        n_values = X.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+        n_values[~nonzero.any(axis=1)] = 0
+
+        timesteps = -(-n_values // self.n_feature)
+        return np.clip(timesteps, 1, self.max_len)
+
+    def _bucket_sequences(self, X, timestep):
+        """Rows of X truncated or padded at the end to timestep steps
+
+        The time steps after the end of each row (see _timesteps) are
+        PAD_VALUE.
+        """
+        n_values = timestep * self.n_feature
+        n_copy = min(n_values, X.shape[1])
+        lengths = self._timesteps(X) * self.n_feature
+
+        X_bucket = np.full((len(X), n_values), self.PAD_VALUE)
+        X_bucket[:, :n_copy] = np.where(
+            np.arange(n_copy) < lengths[:, np.newaxis], X[:, :n_copy],
+            self.PAD_VALUE)
+
+        return np.reshape(X_bucket, (len(X), timestep, self.n_feature))
+
+    def _n_batches(self, buckets):
+        return int(np.sum(np.ceil(np.bincount(buckets) / self.batch_size)))
+
+    def _bucket_batches(self, X, y, sample_weight, buckets, shuffle=True):
+        """Endless (X, y, sample_weight) batches for fit_generator
+
+        Every batch holds samples of one bucket; with shuffle the samples
+        and the order of the batches are reshuffled every epoch.
+        """
+        while True:
+            batches = []
+            for bucket in np.unique(buckets):
+                index = np.flatnonzero(buckets == bucket)
+                if shuffle:
+                    index = np.random.permutation(index)
+                for start in range(0, len(index), self.batch_size):
+                    batches.append((bucket,
+                                    index[start:start + self.batch_size]))
+
+            if shuffle:
+                order = np.random.permutation(len(batches))
+            else:
+                order = range(len(batches))
+
+            for i in order:
+                bucket, index = batches[i]
+                X_batch = self._bucket_sequences(
+                    X[index], self.bucket_timesteps_[bucket])
+                yield X_batch, y[index], sample_weight[index]
+
     def predict(self, X):
         print("------------------------------------")
         print("LSTMClassifier predict")
@@ -687,11 +950,13 @@ class LSTMClassifier(BaseEstimator, TransformerMixin):
         return f1_score(y, y_predicted)
 
 
-class NeuralNetClassifier(BaseEstimator, TransformerMixin):
+class NeuralNetClassifier(InferenceSessionMixin, BaseEstimator,
+                          TransformerMixin):
     """Neural Net Classifier"""
     def __init__(self, hidden_layers=None, activations=None, regularizer='l2',
                  regularizer_scale=1.0, batch_normalization=True,
-                 batch_size=128, dropout=True, dropout_rate=0.3,
+                 batch_size=128, predict_batch_size=1024,
+                 dropout=True, dropout_rate=0.3,
                  optimizer='Adam', learning_rate=0.01, num_epoch=500,
                  score_metric='f1', one_hot_encoding=True, weighted_class=True,
                  save_path=None):
@@ -700,11 +965,12 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
         self.activations = activations
         self.dropout = dropout
         self.dropout_rate = dropout_rate
-        self.num_epochs = num_epoch
+        self.num_epoch = num_epoch
         self.regularizer = regularizer
         self.regularizer_scale = regularizer_scale
         self.batch_normalization = batch_normalization
         self.batch_size = batch_size
+        self.predict_batch_size = predict_batch_size
         self.score_metric = score_metric
         self.optimizer = optimizer
         self.learning_rate = learning_rate
@@ -715,6 +981,9 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
         self.model_path = None
         self.one_hot_encoder = None
 
+        # inference session, restored once after fit (see predict_proba)
+        self._inference = None
+
         # network structure
         if hidden_layers is None:
             self.hidden_layers = [128, 32]
@@ -727,7 +996,7 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
         if optimizer != "Adam" and optimizer != "GradientDescent":
             assert "invalid optimizer"
 
-    def model(self, X_train, y_train=None):
+    def model(self, X_train, y_train=None, inputs=None):
         n_samples, n_features = np.shape(X_train)
 
         if y_train is None:
@@ -735,15 +1004,23 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
         else:
             _, n_classes = np.shape(y_train)
 
-        tf.reset_default_graph()
         with tf.variable_scope("network"):
-            # input
-            X_tf = tf.placeholder(tf.float64,
-                                  shape=[None, n_features],
-                                  name='X')
-            y_tf = tf.placeholder(tf.float64,
-                                  shape=[None, n_classes],
-                                  name='y')
+            # input (fed, or by default the batches of an input pipeline)
+            if inputs is None:
+                X_tf = tf.placeholder(tf.float64,
+                                      shape=[None, n_features],
+                                      name='X')
+                y_tf = tf.placeholder(tf.float64,
+                                      shape=[None, n_classes],
+                                      name='y')
+            else:
+                X_batch, y_batch = inputs
+                X_tf = tf.placeholder_with_default(X_batch,
+                                                   shape=[None, n_features],
+                                                   name='X')
+                y_tf = tf.placeholder_with_default(y_batch,
+                                                   shape=[None, n_classes],
+                                                   name='y')
             is_training_tf = tf.placeholder(tf.bool,
                                             name='is_training')
 
@@ -803,33 +1080,6 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
 
         return net, X_tf, y_tf, is_training_tf
 
-    def batches(self, X_train, y_train):
-        # size
-        n_samples, _ = np.shape(X_train)
-        batch_size = self.batch_size
-
-        # batchs
-        batches = []
-
-        random_mask = list(np.random.permutation(n_samples))
-        random_X = X_train[random_mask, :]
-        random_Y = y_train[random_mask, :]
-
-        num_batches = n_samples // batch_size
-        for i in range(0, num_batches):
-            batch_X = random_X[batch_size * i:batch_size * i + batch_size, :]
-            batch_Y = random_Y[batch_size * i:batch_size * i + batch_size, :]
-            batch = (batch_X, batch_Y)
-            batches.append(batch)
-
-        if n_samples % batch_size != 0:
-            batch_X = random_X[num_batches * batch_size:n_samples, :]
-            batch_Y = random_Y[num_batches * batch_size:n_samples, :]
-            batch = (batch_X, batch_Y)
-            batches.append(batch)
-
-        return batches
-
     def fit(self, X, y, sample_weight=None):
 
         print("------------------------------------")
@@ -850,11 +1100,15 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
 
         _, n_classes = np.shape(y_onehot)
 
-        # generate batches
-        batches = self.batches(X_train=X, y_train=y_onehot)
+        # the inference session of a previous fit is stale
+        self._close_inference()
 
-        # build neural net
-        network, X_tf, y_tf, is_training_tf = self.model(X, y_onehot)
+        # build neural net, fed by batches reshuffled every epoch
+        tf.reset_default_graph()
+        batch_X, batch_y, batches_init, data_init = _input_pipeline(
+            X, y_onehot, self.batch_size, tf.float64)
+        network, X_tf, y_tf, is_training_tf = self.model(
+            X, y_onehot, inputs=(batch_X, batch_y))
 
         # cost (loss)
         if self.weighted_class:
@@ -900,23 +1154,29 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
 
             # initialization
             sess.run(init_op)
+            sess.run(data_init[0], feed_dict=data_init[1])
 
-            for epoch in range(self.num_epochs):
-                for batch in batches:
-                    batch_X, batch_y = batch
+            for epoch in range(self.num_epoch):
+                sess.run(batches_init)
+                epoch_start = time.time()
 
+                while True:
                     feed = {
-                        X_tf: batch_X,
-                        y_tf: batch_y,
                         is_training_tf: True
                     }
 
-                    _, loss_val = sess.run([train_op, loss],
-                                           feed_dict=feed)
+                    try:
+                        _, loss_val = sess.run([train_op, loss],
+                                               feed_dict=feed)
+                    except tf.errors.OutOfRangeError:
+                        break
 
                     if (epoch % 100) == 0:
                         print(epoch, loss_val)
 
+                print("epoch {}: {:.1f} samples/sec".format(
+                    epoch, n_samples / (time.time() - epoch_start)))
+
             # save tensorflow model
             if self.save_path is None:
                 self.save_path = 'data/tmp/'
@@ -946,26 +1206,23 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
         print("------------------------------------")
         print("NeuralNetClassifier predict_proba")
 
-        # build neural net
-        network, X_tf, _, is_training_tf = self.model(X)
+        # batches of predict_batch_size rows bound the memory of the net
+        return utils.predict_batches(self._predict_proba_batch, X,
+                                     self.predict_batch_size)
 
-        # tensorflow seesion
-        saver = tf.train.Saver()
-
-        with tf.Session() as sess:
-            save_path = self.model_path
-            saver.restore(sess, save_path)
-            print("fitted model restored: {}".format(save_path))
+    def _predict_proba_batch(self, X):
+        sess, X_tf, is_training_tf, predict_op = self._inference_session(X)
 
-            feed = {
-                X_tf: X,
-                is_training_tf: False
-            }
+        feed = {
+            X_tf: X,
+            is_training_tf: False
+        }
 
-            predict_op = tf.nn.softmax(network, name='softmax')
-            P_predicted = sess.run(predict_op, feed_dict=feed)
+        return sess.run(predict_op, feed_dict=feed)
 
-        return P_predicted
+    def _inference_graph(self, X):
+        network, X_tf, _, is_training_tf = self.model(X)
+        return X_tf, is_training_tf, tf.nn.softmax(network, name='softmax')
 
     def predict(self, X):
         print("------------------------------------")
@@ -977,13 +1234,7 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
     def score(self, X, y, sample_weight=None):
         if self.score_metric is 'spearmanr':
             P_predicted = self.predict_proba(X)
-            n_samples, n_labels = np.shape(P_predicted)
-            score = np.zeros(n_samples)
-
-            for i in range(0, n_samples):
-                score[i] = spearmanr(y[i, :], P_predicted[i, :])[0]
-
-            score = np.mean(score)
+            score = np.mean(utils.spearman_rows(y, P_predicted))
         elif self.score_metric is 'f1':
             y_predicted = self.predict(X)
             score = f1_score(y, y_predicted, average="micro")
@@ -995,3 +1246,33 @@ class NeuralNetClassifier(BaseEstimator, TransformerMixin):
 
     def set_save_path(self, save_path):
         self.save_path = save_path
+
+
+def _input_pipeline(X, y, batch_size, dtype):
+    """Training batches of (X, y), reshuffled every epoch
+
+    X and y are copied into the graph once, converted to dtype, as
+    variables outside of the saved/initialized collections; run
+    data_init = (ops, feed_dict) once after the global initializer. Each
+    epoch runs batches_init and then yields batches (gathered rows of a
+    shuffled index, prefetched) until tf.errors.OutOfRangeError.
+    """
+    X_init = tf.placeholder(dtype, shape=np.shape(X))
+    y_init = tf.placeholder(dtype, shape=np.shape(y))
+    X_data = tf.Variable(X_init, trainable=False, collections=[])
+    y_data = tf.Variable(y_init, trainable=False, collections=[])
+
+    dataset = tf.data.Dataset.range(len(X)) \
+        .shuffle(len(X)) \
+        .batch(batch_size) \
+        .map(lambda index: (tf.gather(X_data, index),
+                            tf.gather(y_data, index))) \
+        .prefetch(1)
+
+    iterator = dataset.make_initializable_iterator()
+    batch_X, batch_y = iterator.get_next()
+
+    data_init = ([X_data.initializer, y_data.initializer],
+                 {X_init: X, y_init: y})
+
+    return batch_X, batch_y, iterator.initializer, data_init
@@ -1,15 +1,28 @@
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.utils.validation import check_array
+from sklearn.utils.validation import check_array, check_is_fitted
 from ml_project.models import utils
 from biosppy.signals import ecg
 from biosppy.signals import tools
+import biosppy
+from sklearn.externals.joblib import Parallel, delayed
 import numpy as np
+import os
 import cv2
 import pywt
 
 
-class IntensityHistogram(BaseEstimator, TransformerMixin):
-    """Feature from intensity histogram of 3D images"""
+class IntensityHistogram(BaseEstimator, TransformerMixin,
+                         utils.ChunkTransformMixin):
+    """Feature from intensity histogram of 3D images
+
+    The counts are returned as dtype (e.g. uint16, enough for the
+    default cells; transform raises a ValueError if an integer dtype
+    cannot hold the voxel count of a cell). With sparse they are a
+    scipy.sparse CSR matrix; most cells lie in the zero background. With
+    use_mask, fit stores the index of the voxels non-zero in the training
+    images (voxel_index_) and transform treats all other voxels as
+    background.
+    """
 
     # divide 3d image into cells and make histogram per cell
     def __init__(self,
@@ -17,6 +30,11 @@ class IntensityHistogram(BaseEstimator, TransformerMixin):
                  y_cell_number=8,
                  z_cell_number=8,
                  bin_number=45,
+                 dtype=np.float64,
+                 sparse=False,
+                 use_mask=False,
+                 n_jobs=1,
+                 cache=False,
                  verbosity=1):
 
         # image dimension
@@ -30,6 +48,11 @@ class IntensityHistogram(BaseEstimator, TransformerMixin):
         self.y_cell_number = y_cell_number
         self.z_cell_number = z_cell_number
         self.bin_number = bin_number
+        self.dtype = dtype
+        self.sparse = sparse
+        self.use_mask = use_mask
+        self.n_jobs = n_jobs
+        self.cache = cache
 
         # verbosity
         self.verbosity = verbosity
@@ -43,9 +66,12 @@ class IntensityHistogram(BaseEstimator, TransformerMixin):
                                                    self.z_cell_number))
             print("bin numbers = {}".format(self.bin_number))
 
-        # no internal variable
         X = check_array(X)
 
+        # brain voxels, the only ones transform looks at
+        if self.use_mask:
+            self.voxel_index_ = utils.voxel_index(X)
+
         return self
 
     def transform(self, X, y=None):
@@ -53,69 +79,78 @@ class IntensityHistogram(BaseEstimator, TransformerMixin):
         X = check_array(X)
         n_samples, n_features = np.shape(X)
 
+        if self.use_mask:
+            check_is_fitted(self, ["voxel_index_"])
+
+        utils.check_count_dtype(self.dtype, (self.x_cell_number,
+                                             self.y_cell_number,
+                                             self.z_cell_number))
+
         if self.verbosity > 0:
             print("------------------------------------")
             print("IntensityHistogram transform")
             print("shape of X before transform : ")
             print(X.shape)
 
-        X_3D = np.reshape(X, (-1,
-                              self.imageDimX,
-                              self.imageDimY,
-                              self.imageDimZ))
+        n_features_new = self.x_cell_number * self.y_cell_number * \
+            self.z_cell_number * self.bin_number
 
-        # cell (contains index of voxels) as bin edge
-        x_cell_edges = np.linspace(0,
-                                   self.imageDimX,
-                                   self.x_cell_number + 1,
-                                   dtype=int)
-        y_cell_edges = np.linspace(0,
-                                   self.imageDimY,
-                                   self.y_cell_number + 1,
-                                   dtype=int)
-        z_cell_edges = np.linspace(0,
-                                   self.imageDimZ,
-                                   self.z_cell_number + 1,
-                                   dtype=int)
+        X_new = utils.cached_transform(
+            self, X, lambda X: utils.parallel_transform(
+                self._transform, X, n_features_new, self.n_jobs,
+                self.dtype, sparse_output=self.sparse))
 
-        # histograms
-        histogram = np.zeros((n_samples,
-                              self.x_cell_number,
-                              self.y_cell_number,
-                              self.z_cell_number,
-                              self.bin_number))
-
-        for i in range(0, n_samples):
-            image_3D = X_3D[i, :, :, :]
+        if self.verbosity > 0:
+            print("shape of X after transform : ")
+            print(X_new.shape)
 
-            for xi in range(0, x_cell_edges.size - 1):
-                for yi in range(0, y_cell_edges.size - 1):
-                    for zi in range(0, z_cell_edges.size - 1):
+        return X_new
 
-                        # image block for histogram
-                        image_block = image_3D[
-                                      x_cell_edges[xi]:x_cell_edges[xi+1],
-                                      y_cell_edges[yi]:y_cell_edges[yi+1],
-                                      z_cell_edges[zi]:z_cell_edges[zi+1]]
+    def _transform(self, X):
+        n_samples, n_features = np.shape(X)
 
-                        # histogram
-                        histogram[i, xi, yi, zi, :], bins = \
-                            np.histogram(image_block,
-                                         bins=np.linspace(0,
-                                                          self.histBinMax,
-                                                          self.bin_number + 1))
+        # cells of the 3D images (rows of X are C-ordered)
+        dimensions = (self.imageDimX, self.imageDimY, self.imageDimZ)
+        cells = utils.cell_slices((self.x_cell_number,
+                                   self.y_cell_number,
+                                   self.z_cell_number), dimensions)
+
+        bin_edges = np.linspace(0, self.histBinMax, self.bin_number + 1)
+
+        # with the mask, cells are the flat indices of their voxels in it;
+        # the others are background (0), only counted into the first bin
+        zero_counts = 0
+        if self.use_mask:
+            in_mask = np.zeros(np.prod(dimensions), dtype=bool)
+            in_mask[self.voxel_index_] = True
+            in_mask = np.reshape(in_mask, dimensions)
+            voxels = np.reshape(np.arange(in_mask.size), dimensions)
+
+            zero_counts = np.zeros(len(cells) * self.bin_number,
+                                   dtype=np.intp)
+            zero_counts[::self.bin_number] = [np.sum(~in_mask[cell])
+                                              for cell in cells]
+            cells = [voxels[cell][in_mask[cell]] for cell in cells]
+            dimensions = (-1,)
 
-        X_new = np.reshape(histogram, (n_samples, -1))
+        # histograms
+        X_new = np.zeros((n_samples, len(cells) * self.bin_number),
+                         dtype=self.dtype)
 
-        if self.verbosity > 0:
-            print("shape of X after transform : ")
-            print(X_new.shape)
+        for i in range(0, n_samples):
+            X_new[i, :] = utils.cell_histogram(
+                np.reshape(X[i, :], dimensions), cells, bin_edges) + \
+                zero_counts
 
         return X_new
 
 
-class GradientHistogram(BaseEstimator, TransformerMixin):
-    """Feature from intensity histogram of 3D images"""
+class GradientHistogram(BaseEstimator, TransformerMixin,
+                        utils.ChunkTransformMixin):
+    """Feature from intensity histogram of 3D images
+
+    dtype, sparse and use_mask as for IntensityHistogram.
+    """
 
     # divide 3d image into cells and make histogram per cell
     def __init__(self,
@@ -125,6 +160,11 @@ class GradientHistogram(BaseEstimator, TransformerMixin):
                  theta_bin_number=18,
                  phi_bin_number=9,
                  save_path=None,
+                 dtype=np.float64,
+                 sparse=False,
+                 use_mask=False,
+                 n_jobs=1,
+                 cache=False,
                  verbosity=1):
 
         # image dimension
@@ -140,6 +180,11 @@ class GradientHistogram(BaseEstimator, TransformerMixin):
         self.theta_bin_number = theta_bin_number
         self.phi_bin_number = phi_bin_number
         self.save_path = save_path
+        self.dtype = dtype
+        self.sparse = sparse
+        self.use_mask = use_mask
+        self.n_jobs = n_jobs
+        self.cache = cache
 
         self.max_gradient = None
 
@@ -156,9 +201,12 @@ class GradientHistogram(BaseEstimator, TransformerMixin):
             print("bin numbers = {}x{}".format(self.theta_bin_number,
                                                self.phi_bin_number))
 
-        # no internal variable
         X = check_array(X)
 
+        # brain voxels, the only ones transform looks at
+        if self.use_mask:
+            self.voxel_index_ = utils.voxel_index(X)
+
         return self
 
     def transform(self, X, y=None):
@@ -166,106 +214,121 @@ class GradientHistogram(BaseEstimator, TransformerMixin):
         X = check_array(X)
         n_samples, n_features = np.shape(X)
 
+        if self.use_mask:
+            check_is_fitted(self, ["voxel_index_"])
+
+        utils.check_count_dtype(self.dtype, (self.x_cell_number,
+                                             self.y_cell_number,
+                                             self.z_cell_number))
+
         if self.verbosity > 0:
             print("------------------------------------")
             print("GradientHistogram transform")
             print("shape of X before transform : ")
             print(X.shape)
 
+        n_features_new = self.x_cell_number * self.y_cell_number * \
+            self.z_cell_number * self.theta_bin_number * self.phi_bin_number
+
+        X_new = utils.cached_transform(
+            self, X, lambda X: utils.parallel_transform(
+                self._transform, X, n_features_new, self.n_jobs,
+                self.dtype, sparse_output=self.sparse))
+
+        if self.verbosity > 0:
+            print("shape of X after transform : ")
+            print(X_new.shape)
+
+        return X_new
+
+    def _transform(self, X):
+        n_samples, n_features = np.shape(X)
+
         X_3D = np.reshape(X, (-1,
                               self.imageDimX,
                               self.imageDimY,
                               self.imageDimZ))
 
-        # cell (contains index of voxels) as bin edge
-        x_edges = np.linspace(0,
-                              self.imageDimX,
-                              self.x_cell_number + 1,
-                              dtype=int)
-        y_edges = np.linspace(0,
-                              self.imageDimY,
-                              self.y_cell_number + 1,
-                              dtype=int)
-        z_edges = np.linspace(0,
-                              self.imageDimZ,
-                              self.z_cell_number + 1,
-                              dtype=int)
-
-        # histograms
-        hist = np.zeros((n_samples,
-                         self.x_cell_number,
-                         self.y_cell_number,
-                         self.z_cell_number,
-                         self.theta_bin_number,
-                         self.phi_bin_number))
+        # cell of every voxel
+        cell_numbers = (self.x_cell_number,
+                        self.y_cell_number,
+                        self.z_cell_number)
+        n_cells = np.prod(cell_numbers)
+        n_bins = self.theta_bin_number * self.phi_bin_number
+        cells = utils.cell_index(cell_numbers,
+                                 (self.imageDimX,
+                                  self.imageDimY,
+                                  self.imageDimZ)) * n_bins
+
+        # with the mask, voxels outside of it are background (0), as for
+        # IntensityHistogram, and gradients are computed in the bounding
+        # box of the mask grown by 2 voxels: outside of it they are 0 (and
+        # at its border one-sided differences of zeros give 0 as well)
+        crop = (slice(None),) * 3
+        background = None
+        if self.use_mask:
+            crop = utils.voxel_crop(self.voxel_index_, margin=2)
+            cells = np.reshape(cells, X_3D.shape[1:])[crop].ravel()
+
+            background = np.ones(X_3D.shape[1:], dtype=bool)
+            background.flat[self.voxel_index_] = False
+            background = background[crop]
+
+        theta_edges = np.linspace(-180, 180, self.theta_bin_number + 1)
+        phi_edges = np.linspace(0, 180, self.phi_bin_number + 1)
+
+        # histograms (one bincount over all cells per image)
+        X_new = np.zeros((n_samples, n_cells * n_bins), dtype=self.dtype)
 
         for i in range(0, n_samples):
-            image_3D = X_3D[i, :, :, :]
-            gradient = np.gradient(image_3D.astype('float32'))
+            image_3D = X_3D[i][crop].astype('float32')
+            if background is not None:
+                image_3D[background] = 0
+            if min(image_3D.shape) < 2:
+                continue
+            gradient_x, gradient_y, gradient_z = np.gradient(image_3D)
+
+            # magnitude, only strong gradients enter the histogram
+            norm = np.sqrt(gradient_x * gradient_x +
+                           gradient_y * gradient_y +
+                           gradient_z * gradient_z)
+            mask = norm > 0.8
+            norm = norm[mask]
 
             # normalize
-            norm = np.linalg.norm(gradient, axis=0)
-            gradient = [np.where(norm == 0, 0, i / norm) for i in gradient]
-
-            for xi in range(0, x_edges.size - 1):
-                for yi in range(0, y_edges.size - 1):
-                    for zi in range(0, z_edges.size - 1):
-
-                        block_x = gradient[0][
-                                  x_edges[xi]:x_edges[xi+1],
-                                  y_edges[yi]:y_edges[yi+1],
-                                  z_edges[zi]:z_edges[zi+1]]
-                        block_y = gradient[1][
-                                  x_edges[xi]:x_edges[xi+1],
-                                  y_edges[yi]:y_edges[yi+1],
-                                  z_edges[zi]:z_edges[zi+1]]
-                        block_z = gradient[2][
-                                  x_edges[xi]:x_edges[xi+1],
-                                  y_edges[yi]:y_edges[yi+1],
-                                  z_edges[zi]:z_edges[zi+1]]
-                        block_mag = norm[
-                                    x_edges[xi]:x_edges[xi+1],
-                                    y_edges[yi]:y_edges[yi+1],
-                                    z_edges[zi]:z_edges[zi+1]]
-
-                        block_x = block_x.flatten()
-                        block_y = block_y.flatten()
-                        block_z = block_z.flatten()
-                        block_mag = block_mag.flatten()
-
-                        block_x = block_x[block_mag > 0.8]
-                        block_y = block_y[block_mag > 0.8]
-                        block_z = block_z[block_mag > 0.8]
-
-                        # theta and phi
-                        theta_block = np.arctan2(block_y,
-                                                 block_x) * 180.0 / np.pi
-                        phi_block = np.arccos(block_z) * 180.0 / np.pi
-
-                        bins = (np.linspace(-180, 180,
-                                            self.theta_bin_number + 1),
-                                np.linspace(0, 180,
-                                            self.phi_bin_number + 1))
-
-                        # histogram
-                        hist[i, xi, yi, zi, :, :], theta_edge, phi_edge = \
-                            np.histogram2d(theta_block, phi_block, bins=bins)
-
-        X_new = np.reshape(hist, (n_samples, -1))
+            gradient_x = gradient_x[mask] / norm
+            gradient_y = gradient_y[mask] / norm
+            gradient_z = gradient_z[mask] / norm
 
-        if self.verbosity > 0:
-            print("shape of X after transform : ")
-            print(X_new.shape)
+            # theta and phi
+            theta = np.arctan2(gradient_y, gradient_x) * 180.0 / np.pi
+            phi = np.arccos(gradient_z) * 180.0 / np.pi
+
+            theta_bins = utils.bin_index(theta, theta_edges)
+            phi_bins = utils.bin_index(phi, phi_edges)
+            valid = (theta_bins >= 0) & (phi_bins >= 0)
+
+            # histogram
+            index = cells[mask.ravel()] + \
+                theta_bins * self.phi_bin_number + phi_bins
+
+            X_new[i, :] = np.bincount(index[valid],
+                                      minlength=n_cells * n_bins)
 
         return X_new
 
 
-class SiftDetector(BaseEstimator, TransformerMixin):
-    """Sift feature for each cut (plane // XY)"""
+class SiftDetector(BaseEstimator, TransformerMixin,
+                   utils.ChunkTransformMixin):
+    """Sift feature for each cut (plane // XY)
+
+    With use_mask, planes without voxels of voxel_index_ (the voxels
+    non-zero in the images fit saw) are skipped.
+    """
 
     # divide 3d image into cells and make histogram per cell
     def __init__(self, split_number_axis0=8, split_number_axis1=8,
-                 axis='z', verbosity=0):
+                 axis='z', use_mask=False, n_jobs=1, verbosity=0):
 
         # image dimension
         self.image_dimension_x = utils.Constants.IMAGE_DIM_X
@@ -276,6 +339,8 @@ class SiftDetector(BaseEstimator, TransformerMixin):
         self.split_number_axis1 = split_number_axis1
 
         self.axis = axis
+        self.use_mask = use_mask
+        self.n_jobs = n_jobs
         self.verbosity = verbosity
 
     def fit(self, X, y=None):
@@ -286,9 +351,12 @@ class SiftDetector(BaseEstimator, TransformerMixin):
             print("shape of X before transform : ")
             print(X.shape)
 
-        # no internal variable
         X = check_array(X)
 
+        # brain voxels, the only ones transform looks at
+        if self.use_mask:
+            self.voxel_index_ = utils.voxel_index(X)
+
         return self
 
     def transform(self, X, y=None):
@@ -296,20 +364,25 @@ class SiftDetector(BaseEstimator, TransformerMixin):
         X = check_array(X)
         n_samples, n_features = np.shape(X)
 
+        if self.use_mask:
+            check_is_fitted(self, ["voxel_index_"])
+
         if self.verbosity > 0:
             print("------------------------------------")
             print("SiftDetector transform with axis={}".format(self.axis))
             print("shape of X before transform : ")
             print(X.shape)
 
-        # sift
-        sift = cv2.xfeatures2d.SIFT_create()
+        X_new = utils.parallel_transform(self._transform, X,
+                                         self._n_features(), self.n_jobs)
 
-        X_3D = np.reshape(X, (-1,
-                              self.image_dimension_x,
-                              self.image_dimension_y,
-                              self.image_dimension_z))
+        if self.verbosity > 0:
+            print("shape of X after transform : ")
+            print(X_new.shape)
+
+        return X_new
 
+    def _plane_dimensions(self):
         # cell (contains index of voxels) as bin edge
         if self.axis == 'z':
             # xy plane
@@ -327,6 +400,54 @@ class SiftDetector(BaseEstimator, TransformerMixin):
             dimension_axis1 = self.image_dimension_z
             number_image_plane = self.image_dimension_x
 
+        return dimension_axis0, dimension_axis1, number_image_plane
+
+    def _transform(self, X):
+        n_samples, n_features = np.shape(X)
+
+        # sift
+        sift = cv2.xfeatures2d.SIFT_create()
+
+        X_new = np.zeros((n_samples, self._n_features()))
+
+        planes = None
+        if self.use_mask:
+            planes = self._mask_planes(self.voxel_index_)
+
+        for i in range(0, n_samples):
+            if self.verbosity > 1:
+                print("processing {}th image".format(str(i)))
+
+            X_new[i, :] = self._volume_features(sift, sift_volume(X[i, :]),
+                                                planes)
+
+        return X_new
+
+    def _n_features(self):
+        _, _, number_image_plane = self._plane_dimensions()
+        return number_image_plane * self.split_number_axis0 * \
+            self.split_number_axis1 * 2
+
+    def _mask_planes(self, voxel_index):
+        """Planes along axis which contain voxels of voxel_index"""
+        plane_axis = {'x': 0, 'y': 1, 'z': 2}[self.axis]
+        coordinates = np.unravel_index(voxel_index,
+                                       (self.image_dimension_x,
+                                        self.image_dimension_y,
+                                        self.image_dimension_z))
+        return np.unique(coordinates[plane_axis])
+
+    def _volume_features(self, sift, volume, planes=None):
+        """Position of the first keypoint in each cell of each plane
+
+        Keypoints are detected on whole planes of the uint8 volume and
+        mapped back to the cell they fall in; the position is relative to
+        the cell corner, (0, 0) if the cell has no keypoint. Only planes
+        are searched if given, the others are empty background.
+        """
+        dimension_axis0, dimension_axis1, number_image_plane = \
+            self._plane_dimensions()
+
         # cell edges
         cell_edges1 = np.linspace(0,
                                   dimension_axis0,
@@ -337,73 +458,67 @@ class SiftDetector(BaseEstimator, TransformerMixin):
                                   self.split_number_axis1 + 1,
                                   dtype=int)
 
-        X_new = np.zeros((n_samples,
-                          number_image_plane,
-                          self.split_number_axis0,
-                          self.split_number_axis1,
-                          2))
+        features = np.zeros((number_image_plane,
+                             self.split_number_axis0 *
+                             self.split_number_axis1,
+                             2))
 
-        for i in range(0, n_samples):
-            image_3D = X_3D[i, :, :, :]
+        # cutting axis
+        plane_axis = {'x': 0, 'y': 1, 'z': 2}[self.axis]
 
-            if self.verbosity > 1:
-                print("processing {}th image".format(str(i)))
+        if planes is None:
+            planes = range(0, number_image_plane)
 
-            # cutting axis
-            for zi in range(0, number_image_plane):
-                # axis1
-                for xi in range(0, cell_edges1.size - 1):
-                    # axis2
-                    for yi in range(0, cell_edges2.size - 1):
-                        # image block for histogram
-
-                        if self.axis == 'z':
-                            # xy planes
-                            image_block = image_3D[
-                                          cell_edges1[xi]:cell_edges1[xi + 1],
-                                          cell_edges2[yi]:cell_edges2[yi + 1],
-                                          zi]
-                        elif self.axis == 'y':
-                            # xz planes
-                            image_block = image_3D[
-                                          cell_edges1[xi]:cell_edges1[xi + 1],
-                                          zi,
-                                          cell_edges2[yi]:cell_edges2[yi + 1]]
-                        elif self.axis == 'x':
-                            # yz planes
-                            image_block = image_3D[
-                                          zi,
-                                          cell_edges1[xi]:cell_edges1[xi + 1],
-                                          cell_edges2[yi]:cell_edges2[yi + 1]]
-
-                        # normalize for feature
-                        image_block \
-                            = image_block / utils.Constants.IMAGE_VALUE_MAX
-                        image_block = np.array(image_block * 255,
-                                               dtype=np.uint8)
-
-                        kp = sift.detect(image_block, None)
-
-                        if len(kp) > 0:
-                            X_new[i, zi, xi, yi, :] = np.array(kp[0].pt)
-
-        X_new = np.reshape(X_new, (n_samples, -1))
+        for zi in planes:
+            plane = np.ascontiguousarray(np.take(volume, zi, axis=plane_axis))
 
-        if self.verbosity > 0:
-            print("shape of X after transform : ")
-            print(X_new.shape)
+            kp = sift.detect(plane, None)
+            if len(kp) == 0:
+                continue
 
-        return X_new
+            # keypoint (column, row) to cell (row along axis0)
+            pt = np.array([k.pt for k in kp])
+            xi = np.clip(np.searchsorted(cell_edges1, pt[:, 1],
+                                         side='right') - 1,
+                         0, self.split_number_axis0 - 1)
+            yi = np.clip(np.searchsorted(cell_edges2, pt[:, 0],
+                                         side='right') - 1,
+                         0, self.split_number_axis1 - 1)
+
+            cell, first = np.unique(xi * self.split_number_axis1 + yi,
+                                    return_index=True)
+            corner = np.column_stack((cell_edges2[yi], cell_edges1[xi]))
+            features[zi, cell, :] = (pt - corner)[first]
+
+        return features.ravel()
+
+
+def sift_volume(x):
+    """Image row x as uint8 3D volume, the input of SIFT detection"""
+    volume = np.reshape(x, (utils.Constants.IMAGE_DIM_X,
+                            utils.Constants.IMAGE_DIM_Y,
+                            utils.Constants.IMAGE_DIM_Z))
+    return np.array(volume / utils.Constants.IMAGE_VALUE_MAX * 255,
+                    dtype=np.uint8)
 
 
 # =============================================================================
 # Feature combinations
 # =============================================================================
 
-class SiftAllAxis(BaseEstimator, TransformerMixin):
-    """Sift feature for each cut (plane // XY, YZ, ZX)"""
+class SiftAllAxis(BaseEstimator, TransformerMixin,
+                  utils.ChunkTransformMixin):
+    """Sift feature for each cut (plane // XY, YZ, ZX)
+
+    The three axes are computed in one pass over each volume. use_mask
+    as for SiftDetector.
+    """
+    # 1: keypoints of all three axes from the single pass
+    feature_version = 1
+
     def __init__(self, split_number_axis0=8,
-                 split_number_axis1=8, verbosity=0):
+                 split_number_axis1=8, use_mask=False, n_jobs=1,
+                 cache=False, verbosity=0):
         # image dimension
         self.image_dimension_x = utils.Constants.IMAGE_DIM_X
         self.image_dimension_y = utils.Constants.IMAGE_DIM_Y
@@ -412,16 +527,22 @@ class SiftAllAxis(BaseEstimator, TransformerMixin):
         self.split_number_axis0 = split_number_axis0
         self.split_number_axis1 = split_number_axis1
 
+        self.use_mask = use_mask
+        self.n_jobs = n_jobs
+        self.cache = cache
         self.verbosity = verbosity
         self.sift1 = SiftDetector(split_number_axis0=split_number_axis0,
                                   split_number_axis1=split_number_axis1,
-                                  axis='z', verbosity=verbosity)
+                                  axis='z', n_jobs=n_jobs,
+                                  verbosity=verbosity)
         self.sift2 = SiftDetector(split_number_axis0=split_number_axis0,
                                   split_number_axis1=split_number_axis1,
-                                  axis='y', verbosity=verbosity)
+                                  axis='y', n_jobs=n_jobs,
+                                  verbosity=verbosity)
         self.sift3 = SiftDetector(split_number_axis0=split_number_axis0,
                                   split_number_axis1=split_number_axis1,
-                                  axis='x', verbosity=verbosity)
+                                  axis='x', n_jobs=n_jobs,
+                                  verbosity=verbosity)
 
     def fit(self, X, y=None):
 
@@ -431,9 +552,12 @@ class SiftAllAxis(BaseEstimator, TransformerMixin):
             print("shape of X before transform : ")
             print(X.shape)
 
-        # no internal variable
         X = check_array(X)
 
+        # brain voxels, the only ones transform looks at
+        if self.use_mask:
+            self.voxel_index_ = utils.voxel_index(X)
+
         return self
 
     def transform(self, X, y=None):
@@ -441,15 +565,21 @@ class SiftAllAxis(BaseEstimator, TransformerMixin):
         X = check_array(X)
         n_samples, n_features = np.shape(X)
 
+        if self.use_mask:
+            check_is_fitted(self, ["voxel_index_"])
+
         if self.verbosity > 0:
             print("------------------------------------")
             print("SiftAllAxis transform")
             print("shape of X before transform : ")
             print(X.shape)
 
-        X_new = np.hstack((self.sift1.transform(X, y),
-                           self.sift2.transform(X, y),
-                           self.sift3.transform(X, y)))
+        n_features_new = self.sift1._n_features() + \
+            self.sift2._n_features() + self.sift3._n_features()
+
+        X_new = utils.cached_transform(
+            self, X, lambda X: utils.parallel_transform(
+                self._transform, X, n_features_new, self.n_jobs))
 
         if self.verbosity > 0:
             print("shape of X after transform : ")
@@ -457,8 +587,33 @@ class SiftAllAxis(BaseEstimator, TransformerMixin):
 
         return X_new
 
+    def _transform(self, X):
+        n_samples, n_features = np.shape(X)
+
+        sift = cv2.xfeatures2d.SIFT_create()
+
+        X_new = np.zeros((n_samples, self.sift1._n_features() +
+                          self.sift2._n_features() +
+                          self.sift3._n_features()))
+
+        planes = (None, None, None)
+        if self.use_mask:
+            planes = [detector._mask_planes(self.voxel_index_)
+                      for detector in (self.sift1, self.sift2, self.sift3)]
+
+        # every volume converted once for the three axes
+        for i in range(0, n_samples):
+            volume = sift_volume(X[i, :])
+            X_new[i, :] = np.concatenate((
+                self.sift1._volume_features(sift, volume, planes[0]),
+                self.sift2._volume_features(sift, volume, planes[1]),
+                self.sift3._volume_features(sift, volume, planes[2])))
+
+        return X_new
+
 
-class ImageHistogramAndSift(BaseEstimator, TransformerMixin):
+class ImageHistogramAndSift(BaseEstimator, TransformerMixin,
+                            utils.ChunkTransformMixin):
     def __init__(self):
         self.sift = SiftAllAxis()
         self.image_hist = IntensityHistogram(bin_number=60)
@@ -479,7 +634,8 @@ class ImageHistogramAndSift(BaseEstimator, TransformerMixin):
         return X_new
 
 
-class IntensityAndGradient(BaseEstimator, TransformerMixin):
+class IntensityAndGradient(BaseEstimator, TransformerMixin,
+                           utils.ChunkTransformMixin):
     def __init__(self, verbosity=1):
         self.image_hist = IntensityHistogram(x_cell_number=9,
                                              y_cell_number=9,
@@ -521,15 +677,28 @@ class IntensityAndGradient(BaseEstimator, TransformerMixin):
         return X_new
 
 
-class Wavelet(BaseEstimator, TransformerMixin):
-    """Wavelet sym6 1-4"""
+class Wavelet(BaseEstimator, TransformerMixin,
+              utils.ChunkTransformMixin):
+    """Wavelet sym6 1-4
+
+    With lean, R-peaks are detected by the lean path of ecg_rpeaks instead
+    of the full biosppy ecg.ecg (faster, but the features differ unless
+    the installed biosppy is 0.x). With rpeak_cache (True or a folder)
+    they are looked up in the RpeakIndex of X, see rpeak_index. n_jobs
+    transforms recordings in a process pool.
+    """
 
     def __init__(self, sample_radius=100, sampling_rate=300,
-                 n_peaks=1, verbosity=1):
+                 n_peaks=1, lean=False, rpeak_cache=False, n_jobs=1,
+                 cache=False, verbosity=1):
         self.sample_radius = sample_radius
         self.sampling_rate = sampling_rate
         self.verbosity = verbosity
         self.n_peaks = n_peaks
+        self.lean = lean
+        self.rpeak_cache = rpeak_cache
+        self.n_jobs = n_jobs
+        self.cache = cache
         self.n_features = None
 
     def fit(self, X, y=None):
@@ -541,9 +710,8 @@ class Wavelet(BaseEstimator, TransformerMixin):
             print("shape of X before transform : ")
             print(X.shape)
 
-        result = ecg.ecg(X[0, :], sampling_rate=self.sampling_rate, show=False)
-        filtered_x = result[1]
-        r_peak = result[2]
+        filtered_x, r_peak = ecg_rpeaks(X[0, :], self.sampling_rate,
+                                        self.lean)
 
         # samples
         filtered_x = filtered_x[
@@ -569,59 +737,77 @@ class Wavelet(BaseEstimator, TransformerMixin):
             print("shape of X before transform : ")
             print(X.shape)
 
-        X_new = np.zeros((n_samples,
-                          (self.n_features[0] +
-                           self.n_features[1] +
-                           self.n_features[2]) * self.n_peaks))
+        n_features_new = (self.n_features[0] +
+                          self.n_features[1] +
+                          self.n_features[2]) * self.n_peaks
 
-        for i in range(0, n_samples):
-            x = X[i, :]
+        X_new = utils.cached_transform(
+            self, X, lambda X: utils.parallel_transform(
+                self._transform, X, n_features_new, self.n_jobs,
+                row_args=rpeak_index(X, self)))
 
-            result = ecg.ecg(x, sampling_rate=self.sampling_rate, show=False)
-            filtered_x = result[1]
-            r_peak = result[2]
-
-            # size of features
-            cA4s = np.zeros((self.n_peaks, self.n_features[0]))
-            cD4s = np.zeros((self.n_peaks, self.n_features[1]))
-            cD3s = np.zeros((self.n_peaks, self.n_features[2]))
-            # cD2s = np.zeros((self.n_peaks, self.n_features[3]))
+        if self.verbosity > 0:
+            print("shape of X after transform : ")
+            print(X_new.shape)
 
-            # samples
-            for j in range(1, self.n_peaks + 1):
-                sample = filtered_x[
-                         r_peak[j] - (self.sample_radius-1):
-                         r_peak[j] + (self.sample_radius+1)]
-                sample = tools.normalize(sample)
+        return X_new
 
-                # wavelet
-                cA4, cD4, cD3, _, _ = pywt.wavedec(sample,
-                                                   wavelet='sym6',
-                                                   level=4)
+    def _transform(self, X, rpeaks=None):
+        n_samples, n_features = np.shape(X)
 
-                cA4s[j-1, :] = cA4
-                cD4s[j-1, :] = cD4
-                cD3s[j-1, :] = cD3
-                # cD2s[j-1, :] = cD2
+        # window of 2 * sample_radius samples around every R-peak used
+        offsets = np.arange(-(self.sample_radius - 1), self.sample_radius + 1)
+        windows = np.empty((n_samples, self.n_peaks, len(offsets)))
 
-            # new features
-            X_new[i, :] = np.concatenate((cA4s.flatten(),
-                                         cD4s.flatten(),
-                                         cD3s.flatten()))
+        for i in range(0, n_samples):
+            filtered_x, r_peak = ecg_rpeaks(
+                X[i, :], self.sampling_rate, self.lean,
+                None if rpeaks is None else rpeaks[i])
+
+            index = r_peak[np.arange(1, self.n_peaks + 1), np.newaxis] + \
+                offsets
+            if index.min() < 0 or index.max() >= len(filtered_x):
+                raise ValueError("R-peak window of sample {} exceeds the "
+                                 "recording".format(i))
+            windows[i] = filtered_x[index]
+
+        # normalize every window (as tools.normalize)
+        windows -= windows.mean(axis=-1, keepdims=True)
+        windows /= windows.std(axis=-1, ddof=1, keepdims=True)
+
+        # wavelet of all windows at once
+        coefficients = pywt.wavedec(windows, wavelet='sym6', level=4,
+                                    axis=-1)[:3]
+
+        # new features: cA4, cD4, cD3 of peak 1..n_peaks each
+        X_new = np.empty((n_samples,
+                          (self.n_features[0] +
+                           self.n_features[1] +
+                           self.n_features[2]) * self.n_peaks))
 
-        if self.verbosity > 0:
-            print("shape of X after transform : ")
-            print(X_new.shape)
+        start = 0
+        for coefficient in coefficients:
+            stop = start + self.n_peaks * coefficient.shape[-1]
+            X_new[:, start:stop] = coefficient.reshape(n_samples, -1)
+            start = stop
 
         return X_new
 
 
-class SampleFromRpeak(BaseEstimator, TransformerMixin):
-    """Wavelet sym6 1-4"""
+class SampleFromRpeak(BaseEstimator, TransformerMixin,
+                      utils.ChunkTransformMixin):
+    """Wavelet sym6 1-4
+
+    lean as for Wavelet.
+    """
 
-    def __init__(self, sample_radius=100, sampling_rate=300, verbosity=1):
+    def __init__(self, sample_radius=100, sampling_rate=300, lean=False,
+                 rpeak_cache=False, n_jobs=1, verbosity=1):
         self.sample_radius = sample_radius
         self.sampling_rate = sampling_rate
+        self.lean = lean
+        self.rpeak_cache = rpeak_cache
+        self.n_jobs = n_jobs
         self.verbosity = verbosity
         self.n_features = None
 
@@ -645,15 +831,26 @@ class SampleFromRpeak(BaseEstimator, TransformerMixin):
             print("shape of X before transform : ")
             print(X.shape)
 
+        X_new = utils.parallel_transform(self._transform, X,
+                                         self.n_features, self.n_jobs,
+                                         row_args=rpeak_index(X, self))
+
+        if self.verbosity > 0:
+            print("shape of X after transform : ")
+            print(X_new.shape)
+
+        return X_new
+
+    def _transform(self, X, rpeaks=None):
+        n_samples, n_features = np.shape(X)
+
         X_new = np.zeros((n_samples,
                           self.n_features))
 
         for i in range(0, n_samples):
-            x = X[i, :]
-
-            result = ecg.ecg(x, sampling_rate=self.sampling_rate, show=False)
-            filtered_x = result[1]
-            r_peak = result[2]
+            filtered_x, r_peak = ecg_rpeaks(
+                X[i, :], self.sampling_rate, self.lean,
+                None if rpeaks is None else rpeaks[i])
 
             # samples
             for j in range(1, 2):
@@ -665,8 +862,162 @@ class SampleFromRpeak(BaseEstimator, TransformerMixin):
             # new features
             X_new[i, :] = np.reshape(sample, (1, self.n_features))
 
-        if self.verbosity > 0:
-            print("shape of X after transform : ")
-            print(X_new.shape)
-
         return X_new
+
+
+# filter of biosppy's ecg.ecg: FIR order (times the sampling rate), band
+# and whether the mean is removed; biosppy 2.0 changed it from the 0.x one
+LEAN_ECG_FILTER = (0.3, [3, 45], False)
+if int(getattr(biosppy, "__version__", "0").split(".")[0]) >= 2:
+    ECG_FILTER = (1.5, [0.67, 45], True)
+else:
+    ECG_FILTER = LEAN_ECG_FILTER
+
+
+def ecg_filtered(signal, sampling_rate, lean=False):
+    """Filtered ECG signal, the first output of ecg_rpeaks
+
+    Not lean, this is the filter ecg.ecg of the installed biosppy
+    applies (ECG_FILTER), lean always the biosppy 0.x one.
+    """
+    order, frequency, center = LEAN_ECG_FILTER if lean else ECG_FILTER
+
+    filtered, _, _ = tools.filter_signal(signal=np.array(signal),
+                                         ftype='FIR',
+                                         band='bandpass',
+                                         order=int(order * sampling_rate),
+                                         frequency=frequency,
+                                         sampling_rate=float(sampling_rate))
+    if center:
+        filtered = filtered - np.mean(filtered)
+
+    return filtered
+
+
+def ecg_rpeaks(signal, sampling_rate, lean=False, rpeaks=None):
+    """Filtered ECG signal and its R-peaks, as biosppy's ecg.ecg returns
+
+    The lean path runs only the steps of biosppy 0.x's ecg.ecg these are
+    computed by: the FIR bandpass filter (order 0.3 * sampling_rate,
+    3-45 Hz), the Hamilton segmenter and the R-peak correction, keeping
+    the R-peaks ecg.ecg keeps when it extracts heartbeat templates (0.2 s
+    before to 0.4 s after the peak). Templates and heart rate are not
+    computed. Later biosppy versions filter differently in ecg.ecg, so
+    there the lean output differs from it. Given rpeaks (e.g. from an
+    RpeakIndex), the signal is only filtered, as the detector with the
+    same lean filters it (see ecg_filtered).
+    """
+    if rpeaks is not None:
+        return ecg_filtered(signal, sampling_rate, lean), rpeaks
+
+    if not lean:
+        result = ecg.ecg(signal, sampling_rate=sampling_rate, show=False)
+        return result[1], result[2]
+
+    filtered = ecg_filtered(signal, sampling_rate, lean=True)
+
+    rpeaks, = ecg.hamilton_segmenter(signal=filtered,
+                                     sampling_rate=sampling_rate)
+    rpeaks, = ecg.correct_rpeaks(signal=filtered,
+                                 rpeaks=rpeaks,
+                                 sampling_rate=sampling_rate,
+                                 tol=0.05)
+
+    # R-peaks with a whole heartbeat template
+    rpeaks = np.sort(rpeaks)
+    before = int(0.2 * sampling_rate)
+    after = int(0.4 * sampling_rate)
+    rpeaks = rpeaks[(rpeaks - before >= 0) &
+                    (rpeaks + after <= len(filtered))]
+
+    return filtered, rpeaks.astype(int)
+
+
+def rpeak_index(X, transformer):
+    """RpeakIndex of X if transformer.rpeak_cache is set, else None
+
+    rpeak_cache is True for the default cache folder or the path of a
+    folder, as cache.
+    """
+    if not transformer.rpeak_cache:
+        return None
+
+    path = "data/cache/"
+    if isinstance(transformer.rpeak_cache, str):
+        path = transformer.rpeak_cache
+
+    return RpeakIndex.load(X, transformer.sampling_rate, transformer.lean,
+                           transformer.n_jobs, path)
+
+
+class RpeakIndex:
+    """R-peaks of all recordings (rows) of X in two flat arrays
+
+    The R-peaks of recording i are peaks[indptr[i]:indptr[i + 1]], a slice
+    of rows is the RpeakIndex of those rows. load keeps the index in
+    data/cache/ as an .npz file keyed by the content of X, the sampling
+    rate and the detector, so detection runs once per data set no matter
+    how many ECG transformers use it.
+    """
+    def __init__(self, indptr, peaks):
+        self.indptr = indptr
+        self.peaks = peaks
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise IndexError("RpeakIndex only supports contiguous "
+                                 "slices")
+            indptr = self.indptr[start:max(start, stop) + 1]
+            return RpeakIndex(indptr - indptr[0],
+                              self.peaks[indptr[0]:indptr[-1]])
+
+        return self.peaks[self.indptr[index]:self.indptr[index + 1]]
+
+    @classmethod
+    def detect(cls, X, sampling_rate, lean=False, n_jobs=1):
+        n_samples = X.shape[0]
+        n_workers = n_jobs
+        if n_jobs < 0:
+            n_workers = max(utils.cpu_count() + 1 + n_jobs, 1)
+        n_chunks = min(4 * n_workers, n_samples)
+        bounds = np.linspace(0, n_samples, n_chunks + 1, dtype=int)
+
+        chunks = Parallel(n_jobs=n_jobs)(
+            delayed(_detect_rpeaks)(X[start:stop], sampling_rate, lean)
+            for start, stop in zip(bounds[:-1], bounds[1:]))
+        rpeaks = [r_peak for chunk in chunks for r_peak in chunk]
+
+        indptr = np.zeros(n_samples + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(r_peak) for r_peak in rpeaks])
+        peaks = np.concatenate(rpeaks + [np.zeros(0, dtype=int)])
+
+        return cls(indptr, peaks)
+
+    @classmethod
+    def load(cls, X, sampling_rate, lean=False, n_jobs=1,
+             path="data/cache/"):
+        key = utils.hash_array(X, ("RpeakIndex", sampling_rate, lean))
+        filename = os.path.join(path, "rpeaks_" + key + ".npz")
+
+        if os.path.exists(filename):
+            with np.load(filename) as data:
+                return cls(data["indptr"], data["peaks"])
+
+        index = cls.detect(X, sampling_rate, lean, n_jobs)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(filename + ".tmp", "wb") as f:
+            np.savez(f, indptr=index.indptr, peaks=index.peaks)
+        os.replace(filename + ".tmp", filename)
+
+        return index
+
+
+def _detect_rpeaks(X, sampling_rate, lean):
+    return [ecg_rpeaks(x, sampling_rate, lean)[1] for x in X]
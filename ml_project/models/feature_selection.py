@@ -3,23 +3,45 @@ from sklearn.utils import check_random_state
 from sklearn.utils.validation import check_array, check_is_fitted
 from sklearn.utils.random import sample_without_replacement
 from sklearn.feature_selection import VarianceThreshold
+from sklearn.utils.sparsefuncs import mean_variance_axis
+from ml_project.models.utils import ChunkTransformMixin
+from scipy import sparse
+import numpy as np
 
 
-class NonZeroSelection(BaseEstimator, TransformerMixin):
-    """Select non-zero voxels"""
+class NonZeroSelection(BaseEstimator, TransformerMixin,
+                       ChunkTransformMixin):
+    """Select non-zero voxels
+
+    Sparse (CSR) input stays sparse and keeps its dtype. partial_fit
+    fits on row chunks, keeping only the running column sums.
+    """
     def fit(self, X, y=None):
-        X = check_array(X)
-        self.nonzero = X.sum(axis=0) > 0
+        if hasattr(self, "sum_"):
+            del self.sum_
+
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y=None):
+        X = check_array(X, accept_sparse="csr", dtype=None)
+        sum_ = np.asarray(X.sum(axis=0, dtype=np.float64)).ravel()
+
+        if hasattr(self, "sum_"):
+            self.sum_ += sum_
+        else:
+            self.sum_ = sum_
+        self.nonzero = self.sum_ > 0
 
         return self
 
     def transform(self, X, y=None):
         check_is_fitted(self, ["nonzero"])
-        X = check_array(X)
-        return X[:, self.nonzero]
+        X = check_array(X, accept_sparse="csr", dtype=None)
+        return X[:, np.flatnonzero(self.nonzero)]
 
 
-class RandomSelection(BaseEstimator, TransformerMixin):
+class RandomSelection(BaseEstimator, TransformerMixin,
+                      ChunkTransformMixin):
     """Random Selection of features"""
     def __init__(self, n_components=1000, random_state=None):
         self.n_components = n_components
@@ -46,7 +68,8 @@ class RandomSelection(BaseEstimator, TransformerMixin):
         return X_new
 
 
-class RandomSequentialSelection(BaseEstimator, TransformerMixin):
+class RandomSequentialSelection(BaseEstimator, TransformerMixin,
+                                ChunkTransformMixin):
     """Random Selection of features but sort in ascending order"""
     def __init__(self, n_components=1000, random_state=None, max_len=9000):
         self.n_components = n_components
@@ -81,8 +104,13 @@ class RandomSequentialSelection(BaseEstimator, TransformerMixin):
         return X_new
 
 
-class VarianceThreshold(VarianceThreshold):
-    """VarianceThreshold"""
+class VarianceThreshold(VarianceThreshold, ChunkTransformMixin):
+    """VarianceThreshold, sparse input stays sparse
+
+    fit and partial_fit (on row chunks) share one pass: the variances
+    are running moments, chunk means and squared deviations merged as in
+    Chan et al.'s parallel variance (Welford's update for whole chunks).
+    """
     def __init__(self, threshold=0.0):
         self.threshold = threshold
         super(VarianceThreshold, self).__init__(self.threshold)
@@ -92,8 +120,41 @@ class VarianceThreshold(VarianceThreshold):
         print("VarianceThreshold fit with thr = {}"
               .format(self.threshold))
 
-        X = check_array(X)
-        super(VarianceThreshold, self).fit(X)
+        self.n_samples_seen_ = 0
+        self.partial_fit(X)
+
+        if np.all(self.variances_ <= self.threshold):
+            raise ValueError("No feature in X meets the variance threshold "
+                             "{0:.5f}".format(self.threshold))
+
+        return self
+
+    def partial_fit(self, X, y=None):
+        X = check_array(X, accept_sparse=["csr", "csc"], dtype=np.float64)
+        n_samples = X.shape[0]
+
+        # moments of the chunk
+        if sparse.issparse(X):
+            mean, variance = mean_variance_axis(X, axis=0)
+        else:
+            mean, variance = X.mean(axis=0), X.var(axis=0)
+        squares = variance * n_samples
+
+        if getattr(self, "n_samples_seen_", 0) == 0:
+            self.n_samples_seen_ = 0
+            self.mean_ = np.zeros(X.shape[1])
+            self.squares_ = np.zeros(X.shape[1])
+
+        # merge with the moments of the chunks before
+        n_total = self.n_samples_seen_ + n_samples
+        delta = mean - self.mean_
+        self.mean_ += delta * (n_samples / n_total)
+        self.squares_ += squares + \
+            delta ** 2 * (self.n_samples_seen_ * n_samples / n_total)
+        self.n_samples_seen_ = n_total
+
+        self.variances_ = self.squares_ / n_total
+
         return self
 
     def transform(self, X, y=None):
@@ -101,7 +162,7 @@ class VarianceThreshold(VarianceThreshold):
         print("VarianceThreshold transform with thr = {}"
               .format(self.threshold))
 
-        X = check_array(X)
+        X = check_array(X, accept_sparse="csr", dtype=None)
         print("shape before variance threshold: ")
         print(X.shape)
 
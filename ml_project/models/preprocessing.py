@@ -1,12 +1,22 @@
 from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.utils.validation import check_array
-
-
-class StandardScaler(StandardScaler):
-    """standardize data"""
-    def __init__(self, verbosity=0):
-        super(StandardScaler, self).__init__()
+from sklearn.utils.sparsefuncs import mean_variance_axis
+from scipy import sparse
+from ml_project.models.utils import ChunkTransformMixin, iter_chunks, \
+    predict_batches
+
+
+class StandardScaler(StandardScaler, ChunkTransformMixin):
+    """standardize data
+
+    Sparse input needs with_mean=False and stays sparse. partial_fit
+    (sklearn's running mean and variance) fits on row chunks, see
+    run.py --mmap.
+    """
+    def __init__(self, with_mean=True, with_std=True, verbosity=0):
+        super(StandardScaler, self).__init__(with_mean=with_mean,
+                                             with_std=with_std)
         self.verbosity = verbosity
 
     def fit(self, X, y=None):
@@ -33,16 +43,20 @@ class StandardScaler(StandardScaler):
         X_new = super(StandardScaler, self).transform(X)
 
         if self.verbosity > 0:
+            if sparse.issparse(X_new):
+                mean, variance = mean_variance_axis(X_new, axis=0)
+            else:
+                mean, variance = X_new.mean(axis=0), X_new.var(axis=0)
             print("after standardized: ")
             print("mean = ")
-            print(X_new.mean(axis=0))
+            print(mean)
             print("variance = ")
-            print(X_new.std(axis=0))
+            print(variance)
 
         return X_new
 
 
-class PrincipleComponentAnalysis(PCA):
+class PrincipleComponentAnalysis(PCA, ChunkTransformMixin):
 
     def __init__(self, n_components=None):
         super(PrincipleComponentAnalysis, self).__init__(
@@ -55,9 +69,10 @@ class PrincipleComponentAnalysis(PCA):
         print("------------------------------------")
         print("PCA fit")
         print("n_components = {}".format(self.n_components))
-        print("variances = {}".format(self.explained_variance_))
 
         super(PrincipleComponentAnalysis, self).fit(X, y)
+
+        print("variances = {}".format(self.explained_variance_))
         return self
 
     def transform(self, X, y=None):
@@ -75,3 +90,70 @@ class PrincipleComponentAnalysis(PCA):
         print(X_new.shape)
 
         return X_new
+
+
+class IncrementalPrincipleComponentAnalysis(IncrementalPCA,
+                                            ChunkTransformMixin):
+    """PCA fitted on row chunks (out-of-core)
+
+    fit reads X in chunks of batch_size rows, so memory-mapped X is never
+    loaded as a whole; partial_fit takes one chunk (the first one needs
+    at least n_components rows). transform works in chunks as well.
+    n_components has to be given, fitting chunk by chunk cannot pick it.
+    """
+
+    # fit is out-of-core itself, run.py --mmap calls it over partial_fit
+    out_of_core_fit = True
+
+    def __init__(self, n_components=None, batch_size=256, verbosity=1):
+        super(IncrementalPrincipleComponentAnalysis, self).__init__(
+            n_components=n_components, batch_size=batch_size)
+        self.verbosity = verbosity
+
+    def fit(self, X, y=None):
+        if self.verbosity > 0:
+            print("------------------------------------")
+            print("IncrementalPCA fit")
+            print("n_components = {}".format(self.n_components))
+
+        self._check_n_components()
+
+        if hasattr(self, "components_"):
+            del self.components_
+            del self.n_samples_seen_
+
+        for X_chunk in iter_chunks(X, self.batch_size, merge_last=True):
+            self.partial_fit(X_chunk)
+
+        if self.verbosity > 0:
+            print("variances = {}".format(self.explained_variance_))
+
+        return self
+
+    def partial_fit(self, X, y=None, check_input=True):
+        self._check_n_components()
+
+        return super(IncrementalPrincipleComponentAnalysis,
+                     self).partial_fit(X, y, check_input)
+
+    def _check_n_components(self):
+        if self.n_components is None:
+            raise ValueError("IncrementalPrincipleComponentAnalysis needs "
+                             "n_components")
+
+    def transform(self, X, y=None):
+        if self.verbosity > 0:
+            print("------------------------------------")
+            print("IncrementalPCA transform")
+            print("shape of X before pca : ")
+            print(X.shape)
+
+        X_new = predict_batches(
+            super(IncrementalPrincipleComponentAnalysis, self).transform,
+            X, self.batch_size)
+
+        if self.verbosity > 0:
+            print("shape of X after pca : ")
+            print(X_new.shape)
+
+        return X_new
@@ -1,7 +1,14 @@
 from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
 from scipy.ndimage import zoom
 from sklearn.utils.validation import check_array
+from scipy import sparse
 import numpy as np
+import tempfile
+import hashlib
+import shutil
+import mmap
+import os
 
 
 class Constants:
@@ -13,17 +20,482 @@ class Constants:
     IMAGE_FULL_FEATURE = 6443008
 
 
-class ImageDownSampling(BaseEstimator, TransformerMixin):
-    """Down sample image"""
+def cell_index(cell_numbers, dimensions=(Constants.IMAGE_DIM_X,
+                                         Constants.IMAGE_DIM_Y,
+                                         Constants.IMAGE_DIM_Z)):
+    """Flat cell index of every voxel (C order) for a regular cell grid
 
-    def __init__(self, scale=0.5):
+    Cell edges are np.linspace(0, dim, n + 1, dtype=int) per axis,
+    i.e. the same cells the extractors used to slice out block by block.
+    """
+    axis_index = []
+    for dimension, cell_number in zip(dimensions, cell_numbers):
+        edges = np.linspace(0, dimension, cell_number + 1, dtype=int)
+        axis_index.append(
+            np.searchsorted(edges, np.arange(dimension), side='right') - 1)
+
+    x_index, y_index, z_index = axis_index
+    _, y_cell_number, z_cell_number = cell_numbers
+
+    index = (x_index[:, None, None] * y_cell_number +
+             y_index[None, :, None]) * z_cell_number + \
+        z_index[None, None, :]
+
+    return index.ravel()
+
+
+def voxel_index(X, chunk_size=16):
+    """Flat index of the voxels which are non-zero in the images of X
+
+    A voxel is kept if its sum over the images is positive, as in
+    NonZeroSelection. X is summed in row chunks, so memory-mapped X is
+    not loaded as a whole.
+    """
+    total = np.zeros(X.shape[1])
+    for start in range(0, X.shape[0], chunk_size):
+        total += np.sum(X[start:start + chunk_size], axis=0)
+
+    return np.flatnonzero(total > 0).astype(np.int32)
+
+
+def voxel_crop(index, margin=0, dimensions=(Constants.IMAGE_DIM_X,
+                                            Constants.IMAGE_DIM_Y,
+                                            Constants.IMAGE_DIM_Z)):
+    """Slices of the bounding box of flat voxel index, grown by margin"""
+    if len(index) == 0:
+        return tuple(slice(0, 0) for _ in dimensions)
+
+    coordinates = np.unravel_index(index, dimensions)
+    return tuple(slice(max(c.min() - margin, 0), c.max() + margin + 1)
+                 for c in coordinates)
+
+
+def bin_index(values, edges):
+    """Histogram bin of each value as np.histogram assigns it
+
+    Bins are half open [e_k, e_k+1) except the last one, which includes
+    its right edge. Values outside the edges (and NaN) get -1.
+    Edges are expected to be equally spaced (np.linspace): the bin is
+    estimated from the bin width and corrected against the actual edges.
+    """
+    n_bins = len(edges) - 1
+
+    inside = (values >= edges[0]) & (values <= edges[-1])
+
+    index = (values - edges[0]) * (n_bins / (edges[-1] - edges[0]))
+    index[~inside] = 0
+    index = index.astype(np.intp)
+    np.minimum(index, n_bins - 1, out=index)
+
+    # rounding of the estimate
+    index -= values < edges[index]
+    index += (values >= edges[index + 1]) & (index != n_bins - 1)
+
+    index[~inside] = -1
+
+    return index
+
+
+def cell_slices(cell_numbers, dimensions=(Constants.IMAGE_DIM_X,
+                                          Constants.IMAGE_DIM_Y,
+                                          Constants.IMAGE_DIM_Z)):
+    """Slices of every cell of a 3D image, cells in cell_index order"""
+    edges = [np.linspace(0, dimension, cell_number + 1, dtype=int)
+             for dimension, cell_number in zip(dimensions, cell_numbers)]
+
+    return [(slice(x0, x1), slice(y0, y1), slice(z0, z1))
+            for x0, x1 in zip(edges[0][:-1], edges[0][1:])
+            for y0, y1 in zip(edges[1][:-1], edges[1][1:])
+            for z0, z1 in zip(edges[2][:-1], edges[2][1:])]
+
+
+def check_count_dtype(dtype, cell_numbers,
+                      dimensions=(Constants.IMAGE_DIM_X,
+                                  Constants.IMAGE_DIM_Y,
+                                  Constants.IMAGE_DIM_Z)):
+    """Raise a ValueError if dtype cannot hold the voxel count of a cell
+
+    Counts are assigned into the feature matrix unchecked, so an integer
+    dtype too small for the largest cell would silently wrap around.
+    """
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        return
+
+    largest = 1
+    for dimension, cell_number in zip(dimensions, cell_numbers):
+        edges = np.linspace(0, dimension, cell_number + 1, dtype=int)
+        largest *= int(np.max(np.diff(edges)))
+
+    if largest > np.iinfo(dtype).max:
+        raise ValueError("dtype {} cannot hold the count of {} voxels of "
+                         "the largest cell".format(dtype.name, largest))
+
+
+def cell_histogram(image, cells, edges):
+    """Histogram of image per cell
+
+    cells index image, e.g. the slices of cell_slices on a 3D image or
+    arrays of flat voxel indices. Every cell is counted on its own, so no
+    temporary is larger than a cell. The result has shape
+    (n_cells * n_bins,), bins varying fastest within each cell.
+    """
+    return np.concatenate([np.histogram(image[cell], bins=edges)[0]
+                           for cell in cells])
+
+
+def rank_rows(a):
+    """Rank of every element within its row, ties get their average rank
+
+    Same ranks as scipy.stats.rankdata (method 'average') per row.
+    """
+    n_rows, n_columns = a.shape
+    rows = np.arange(n_rows)[:, np.newaxis]
+
+    order = np.argsort(a, axis=1, kind="mergesort")
+    a_sorted = a[rows, order]
+
+    # ties: runs of equal values in the sorted rows (every row starts one)
+    new_run = np.ones(a.shape, dtype=bool)
+    new_run[:, 1:] = a_sorted[:, 1:] != a_sorted[:, :-1]
+    run = np.cumsum(new_run.ravel()) - 1
+
+    # average 1-based position within each run
+    position = np.tile(np.arange(1, n_columns + 1, dtype=float), n_rows)
+    mean_position = np.bincount(run, weights=position) / np.bincount(run)
+
+    ranks = np.empty(a.shape)
+    ranks[rows, order] = mean_position[run].reshape(a.shape)
+
+    return ranks
+
+
+def spearman_rows(a, b):
+    """Spearman correlation of every row of a with the same row of b
+
+    Equals [spearmanr(a[i], b[i])[0] for i in range(len(a))]: NaN for rows
+    containing NaN or constant rows.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+
+    rank_a = rank_rows(a)
+    rank_b = rank_rows(b)
+    rank_a -= rank_a.mean(axis=1, keepdims=True)
+    rank_b -= rank_b.mean(axis=1, keepdims=True)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = (np.sum(rank_a * rank_b, axis=1) /
+                       np.sqrt(np.sum(rank_a * rank_a, axis=1) *
+                               np.sum(rank_b * rank_b, axis=1)))
+
+    correlation[np.isnan(a).any(axis=1) | np.isnan(b).any(axis=1)] = np.nan
+
+    return correlation
+
+
+def parallel_transform(function, X, n_features_new, n_jobs=1,
+                       dtype=np.float64, row_args=None, sparse_output=False,
+                       sparse_chunk_size=64):
+    """Apply function to row chunks of X, in a process pool if n_jobs != 1
+
+    function maps a block of rows of X to the same rows of the new
+    features, which are written into a preallocated output. With several
+    jobs the output is a memory map shared with the workers, so results
+    are not pickled back; joblib memory maps large X for the workers.
+    Row order is kept. n_jobs=-1 uses all cores. If row_args (anything
+    sliceable by rows) is given, function gets the matching slice of it
+    as second argument. With sparse_output the result is a CSR matrix,
+    built from chunks of at most sparse_chunk_size rows so the dense
+    features are never materialized as a whole. Every task only gets its
+    rows of X and row_args, so joblib never reduces all of X per task.
+    """
+    n_samples = X.shape[0]
+
+    if n_jobs < 0:
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+    n_jobs = min(n_jobs, n_samples)
+
+    if sparse_output:
+        n_chunks = max(min(4 * n_jobs, n_samples),
+                       -(-n_samples // sparse_chunk_size), 1)
+        bounds = np.linspace(0, n_samples, n_chunks + 1, dtype=int)
+
+        chunks = Parallel(n_jobs=max(n_jobs, 1))(
+            delayed(_sparse_rows)(function, X[start:stop], n_features_new,
+                                  dtype, _rows(row_args, start, stop))
+            for start, stop in zip(bounds[:-1], bounds[1:]))
+
+        return sparse.vstack(chunks, format="csr", dtype=dtype)
+
+    if n_jobs <= 1:
+        X_new = np.empty((n_samples, n_features_new), dtype=dtype)
+        _transform_rows(function, X, X_new, 0, row_args)
+        return X_new
+
+    # a few chunks per job for load balancing
+    n_chunks = min(4 * n_jobs, n_samples)
+    bounds = np.linspace(0, n_samples, n_chunks + 1, dtype=int)
+
+    folder = tempfile.mkdtemp()
+    try:
+        X_new = np.memmap(os.path.join(folder, "X_new.mmap"),
+                          dtype=dtype,
+                          shape=(n_samples, n_features_new),
+                          mode="w+")
+
+        Parallel(n_jobs=n_jobs)(
+            delayed(_transform_rows)(function, X[start:stop], X_new, start,
+                                     _rows(row_args, start, stop))
+            for start, stop in zip(bounds[:-1], bounds[1:]))
+
+        X_new = np.array(X_new)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return X_new
+
+
+def _rows(row_args, start, stop):
+    return None if row_args is None else row_args[start:stop]
+
+
+def _transform_rows(function, X, X_new, start, row_args=None):
+    """Write function of the rows X into X_new from row start on"""
+    stop = start + X.shape[0]
+    if row_args is None:
+        X_new[start:stop, :] = function(X)
+    else:
+        X_new[start:stop, :] = function(X, row_args)
+
+
+def _sparse_rows(function, X, n_features_new, dtype, row_args=None):
+    X_new = np.empty((X.shape[0], n_features_new), dtype=dtype)
+    _transform_rows(function, X, X_new, 0, row_args)
+    return sparse.csr_matrix(X_new)
+
+
+def iter_chunks(X, chunk_size, merge_last=False):
+    """Yield consecutive blocks of chunk_size rows of X
+
+    For memory-mapped X (np.load with mmap_mode) each block is mapped on
+    its own and unmapped once it is copied, so the pages read stay
+    resident only for one block. With merge_last a last block shorter
+    than chunk_size is joined to the one before (for estimators which
+    need a minimum number of rows per block, e.g. IncrementalPCA).
+    """
+    n_samples = X.shape[0]
+    remap = (isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and
+             X.flags.c_contiguous)
+    row_bytes = X.dtype.itemsize * int(np.prod(X.shape[1:]))
+
+    starts = list(range(0, n_samples, chunk_size))
+    if merge_last and len(starts) > 1 and n_samples - starts[-1] < chunk_size:
+        del starts[-1]
+
+    for start, stop in zip(starts, starts[1:] + [n_samples]):
+        if remap:
+            block = np.memmap(X.filename, dtype=X.dtype, mode="r",
+                              offset=X.offset + start * row_bytes,
+                              shape=(stop - start,) + X.shape[1:])
+            yield np.array(block)
+            del block
+        elif sparse.issparse(X):
+            yield X[start:stop]
+        else:
+            yield np.array(X[start:stop])
+
+
+class FeatureCache:
+    """Disk cache of transformer outputs
+
+    Entries are .npy files (.sparse.npz for sparse features) in path,
+    named by a sha1 of the transformer class, its parameters (except the
+    ones which do not change the result), fitted attributes the result
+    depends on, its feature_version and the content of X. When the files
+    exceed max_size bytes the least recently used ones are removed.
+
+    A transformer's feature_version class attribute (0 if missing) must
+    be bumped by any change of the code that changes its output, so the
+    entries of the older code are not loaded.
+    """
+    SUFFIXES = (".npy", ".sparse.npz")
+    IGNORED_PARAMS = ("verbosity", "n_jobs", "cache", "rpeak_cache",
+                      "save_path")
+    FITTED_ATTRIBUTES = ("voxel_index_",)
+
+    def __init__(self, path="data/cache/", max_size=20 * 2**30):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, estimator, X, block_size=2**24):
+        params = estimator.get_params(deep=False)
+        params = sorted((name, repr(value))
+                        for name, value in params.items()
+                        if name not in self.IGNORED_PARAMS)
+
+        # fitted state the output depends on
+        fitted = [hash_array(getattr(estimator, name))
+                  for name in self.FITTED_ATTRIBUTES
+                  if getattr(estimator, name, None) is not None]
+
+        version = getattr(estimator, "feature_version", 0)
+        return hash_array(X, (type(estimator).__module__,
+                              type(estimator).__name__, version, params,
+                              fitted),
+                          block_size)
+
+    def load(self, key):
+        for suffix, load in zip(self.SUFFIXES, (np.load, sparse.load_npz)):
+            filename = os.path.join(self.path, key + suffix)
+            if os.path.exists(filename):
+                try:
+                    X_new = load(filename)
+                except (IOError, ValueError):
+                    return None
+                os.utime(filename)
+                return X_new
+
+        return None
+
+    def save(self, key, X_new):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # write to a temporary file first, so no partial entry is loaded
+        if sparse.issparse(X_new):
+            filename = os.path.join(self.path, key + ".sparse.npz")
+            with open(filename + ".tmp", "wb") as f:
+                sparse.save_npz(f, X_new)
+        else:
+            filename = os.path.join(self.path, key + ".npy")
+            with open(filename + ".tmp", "wb") as f:
+                np.save(f, X_new)
+        os.replace(filename + ".tmp", filename)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.SUFFIXES):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            total_size -= size
+
+
+def hash_array(X, salt=(), block_size=2**24):
+    """sha1 hex digest of the content of X (plus shape, dtype and salt)
+
+    X is hashed in blocks of about block_size bytes, so memory-mapped X is
+    never copied as a whole.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(repr((salt, X.shape, X.dtype.str)).encode())
+
+    X = X.reshape(X.shape[0], -1)
+    n_rows = max(block_size // max(X[:1].nbytes, 1), 1)
+    for start in range(0, X.shape[0], n_rows):
+        sha1.update(np.ascontiguousarray(X[start:start + n_rows]).data)
+
+    return sha1.hexdigest()
+
+
+def cached_transform(estimator, X, transform):
+    """transform(X), through the FeatureCache if estimator.cache is set
+
+    cache is True for the default cache folder or the path of a folder.
+    """
+    cache = getattr(estimator, "cache", False)
+    if not cache:
+        return transform(X)
+
+    if isinstance(cache, str):
+        cache = FeatureCache(path=cache)
+    else:
+        cache = FeatureCache()
+
+    key = cache.key(estimator, X)
+    X_new = cache.load(key)
+
+    if X_new is None:
+        X_new = transform(X)
+        cache.save(key, X_new)
+    elif getattr(estimator, "verbosity", 1) > 0:
+        print("features loaded from cache {}".format(
+            os.path.join(cache.path, key)))
+
+    return X_new
+
+
+def predict_batches(function, X, batch_size=None):
+    """Apply function to batches of at most batch_size rows of X
+
+    function maps a batch of rows to the same rows of output, which are
+    written into an output preallocated from the first batch. X is an
+    array or an iterable of row blocks (e.g. iter_chunks); each block is
+    batched on its own and only the outputs are concatenated.
+    """
+    if not hasattr(X, "shape"):
+        return np.concatenate([predict_batches(function, X_chunk, batch_size)
+                               for X_chunk in X])
+
+    n_samples = X.shape[0]
+    if batch_size is None or n_samples <= batch_size:
+        return function(X)
+
+    y = None
+    for start in range(0, n_samples, batch_size):
+        stop = min(start + batch_size, n_samples)
+        y_batch = function(X[start:stop])
+
+        if y is None:
+            y = np.empty((n_samples,) + y_batch.shape[1:],
+                         dtype=y_batch.dtype)
+        y[start:stop] = y_batch
+
+    return y
+
+
+class ChunkTransformMixin:
+    """Mixin for transformers which transform row by row after fit
+
+    transform_chunks streams row blocks through transform, so any number
+    of samples can be transformed in bounded memory.
+    """
+    def transform_chunks(self, X_chunks):
+        for X in X_chunks:
+            yield self.transform(X)
+
+
+class ImageDownSampling(BaseEstimator, TransformerMixin, ChunkTransformMixin):
+    """Down sample image
+
+    order is the spline interpolation order of zoom (3 = cubic, 1 =
+    linear, 0 = nearest). With batch_size > 1 that many volumes are
+    zoomed at once as a 4D array (scale 1 along the batch axis); the
+    spline then also spans the batch axis, so this only saves call
+    overhead for order=0 and is slower for higher orders.
+    """
+
+    def __init__(self, scale=0.5, order=3, batch_size=1, n_jobs=1):
         self.scale = scale
+        self.order = order
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None):
 
         print("------------------------------------")
         print("ImageDownSampling fit")
         print("resize scale = {}".format(self.scale))
+        print("interpolation order = {}".format(self.order))
 
         # no internal variables
         X = check_array(X)
@@ -38,25 +510,55 @@ class ImageDownSampling(BaseEstimator, TransformerMixin):
         print("ImageDownSampling transform")
         print("resize scale = {}".format(self.scale))
 
+        print("shape of 3D image before down sampling: ")
+        print((n_samples,
+               Constants.IMAGE_DIM_X,
+               Constants.IMAGE_DIM_Y,
+               Constants.IMAGE_DIM_Z))
+
+        # shape of a down sampled image (as computed by zoom)
+        shape = [int(round(dimension * self.scale))
+                 for dimension in (Constants.IMAGE_DIM_X,
+                                   Constants.IMAGE_DIM_Y,
+                                   Constants.IMAGE_DIM_Z)]
+
+        X_new = parallel_transform(self._transform, X,
+                                   int(np.prod(shape)), self.n_jobs)
+
+        print("shape of 3D image after down sampling: ")
+        print(X_new.shape)
+
+        return X_new
+
+    def _transform(self, X):
+        n_samples, n_features = np.shape(X)
+
         X_3D = np.reshape(X, (-1,
                               Constants.IMAGE_DIM_X,
                               Constants.IMAGE_DIM_Y,
                               Constants.IMAGE_DIM_Z))
 
-        print("shape of 3D image before down sampling: ")
-        print(X_3D.shape)
+        X_new = None
+        batch_size = max(self.batch_size, 1)
 
         # resize (interpolation)
-        for i in range(0, n_samples):
-            rescaled_image = zoom(X_3D[i, :, :, :], self.scale)
+        for start in range(0, n_samples, batch_size):
+            stop = min(start + batch_size, n_samples)
 
-            if i == 0:
-                X_new = rescaled_image.flatten()
+            if stop - start == 1:
+                rescaled_image = zoom(X_3D[start], self.scale,
+                                      order=self.order)[np.newaxis]
             else:
-                X_new = np.row_stack((X_new, rescaled_image.flatten()))
+                rescaled_image = zoom(X_3D[start:stop],
+                                      (1,) + (self.scale,) * 3,
+                                      order=self.order)
 
-        print("shape of 3D image after down sampling: ")
-        print(X_new.shape)
+            rescaled_image = rescaled_image.reshape(stop - start, -1)
+
+            if X_new is None:
+                X_new = np.empty((n_samples, rescaled_image.shape[1]),
+                                 dtype=rescaled_image.dtype)
+            X_new[start:stop, :] = rescaled_image
 
         return X_new
 
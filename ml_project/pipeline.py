@@ -1,14 +1,21 @@
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
+from sklearn.externals.joblib import Memory
 
 
 class Pipeline(Pipeline):
-    """docstring for Pipeline"""
+    """Pipeline of the steps configured in class_list
 
-    def __init__(self, class_list, save_path=None):
+    memory is a folder in which the fitted transformers are cached, see
+    fit. None disables caching.
+    """
+
+    def __init__(self, class_list, save_path=None, memory=None):
         self.class_list = class_list
         self.steps = self.load_steps(class_list)
         super(Pipeline, self).__init__(self.steps)
         self.set_save_path(save_path)
+        self.memory = memory
 
     def load_steps(self, class_list):
         steps = []
@@ -33,3 +40,89 @@ class Pipeline(Pipeline):
             if hasattr(dict_["class"], "set_save_path"):
                 param = {dict_["class"].__name__+"__save_path": save_path}
                 self.set_params(**param)
+
+    def fit(self, X, y=None, **fit_params):
+        if self.memory is None:
+            return super(Pipeline, self).fit(X, y, **fit_params)
+
+        Xt, fit_params = self._fit_cached(X, y, **fit_params)
+        self._final_estimator.fit(Xt, y, **fit_params)
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        if self.memory is None:
+            return super(Pipeline, self).fit_transform(X, y, **fit_params)
+
+        Xt, fit_params = self._fit_cached(X, y, **fit_params)
+        if hasattr(self._final_estimator, "fit_transform"):
+            return self._final_estimator.fit_transform(Xt, y, **fit_params)
+        else:
+            return self._final_estimator.fit(Xt, y, **fit_params).transform(Xt)
+
+    def _fit_cached(self, X, y=None, **fit_params):
+        """Fit all steps but the last one, memoized in self.memory
+
+        Every transformer is cloned and fitted through joblib's Memory,
+        keyed by its params and its input. A step seen before with the
+        same preceding steps and rows of X (e.g. in another grid search
+        candidate on the same CV fold) is loaded instead of refitted.
+        """
+        memory = Memory(cachedir=self.memory, verbose=0)
+        fit_transform_one = memory.cache(_fit_transform_one)
+
+        fit_params_steps = dict((name, {}) for name, step in self.steps)
+        for pname, pval in fit_params.items():
+            step, param = pname.split("__", 1)
+            fit_params_steps[step][param] = pval
+
+        Xt = X
+        for index, (name, transformer) in enumerate(self.steps[:-1]):
+            Xt, transformer = fit_transform_one(clone(transformer), Xt, y,
+                                                **fit_params_steps[name])
+            self.steps[index] = (name, transformer)
+
+        return Xt, fit_params_steps[self.steps[-1][0]]
+
+    def transform_chunks(self, X_chunks):
+        """Yield row chunks of X transformed by all steps
+
+        Chunks are pulled through the steps one at a time, so only the
+        transformed chunk is materialized. All steps have to support
+        transform_chunks (row-wise transformers after fit).
+        """
+        for name, step in self.steps:
+            X_chunks = self._chunk_step(name, step).transform_chunks(X_chunks)
+        return X_chunks
+
+    def predict_chunks(self, X_chunks):
+        """Yield predictions for row chunks of X, see transform_chunks"""
+        for name, step in self.steps[:-1]:
+            X_chunks = self._chunk_step(name, step).transform_chunks(X_chunks)
+
+        if hasattr(self._final_estimator, "predict_chunks"):
+            return self._final_estimator.predict_chunks(X_chunks)
+        else:
+            return (self._final_estimator.predict(X) for X in X_chunks)
+
+    def supports_chunks(self, method="transform"):
+        """Whether transform_chunks (or predict_chunks) can run
+
+        All transformers, and for transform the final step too, have to
+        provide transform_chunks.
+        """
+        steps = self.steps if method == "transform" else self.steps[:-1]
+        return all(hasattr(step, "transform_chunks") for _, step in steps)
+
+    def _chunk_step(self, name, step):
+        if not hasattr(step, "transform_chunks"):
+            raise RuntimeError("Step {} of Pipeline does not support "
+                               "transform_chunks".format(name))
+        return step
+
+
+def _fit_transform_one(transformer, X, y, **fit_params):
+    if hasattr(transformer, "fit_transform"):
+        X_new = transformer.fit_transform(X, y, **fit_params)
+    else:
+        X_new = transformer.fit(X, y, **fit_params).transform(X)
+    return X_new, transformer
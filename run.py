@@ -6,10 +6,13 @@ import sys
 import pandas as pd
 import csv
 
+from scipy import sparse
+from sklearn.base import is_classifier
 from sklearn.externals import joblib
 from abc import ABC
 from abc import abstractmethod
 from ml_project import configparse
+from ml_project.models import utils
 from pprint import pprint
 from os.path import normpath
 from inspect import getfullargspec
@@ -28,6 +31,7 @@ class Action(ABC):
         self.save_path = self._mk_save_folder()
         self.X_new, self.y_new = None, None
         self._X_new_set, self._y_new_set = False, False
+        self._X_new_saved = False
 
     @abstractmethod
     def _save(self):
@@ -49,7 +53,12 @@ class Action(ABC):
 
     def _load_data(self):
         try:
-            X = np.load(self.args.X)
+            if self.args.X.endswith(".npz"):
+                X = sparse.load_npz(self.args.X)
+            elif self.args.mmap:
+                X = np.load(self.args.X, mmap_mode="r")
+            else:
+                X = np.load(self.args.X)
         except FileNotFoundError:
             print("{} not found. "
                   "Please download data first.".format(self.args.X))
@@ -74,8 +83,71 @@ class Action(ABC):
         else:
             return None
 
+    def _chunked(self, method):
+        """Whether the model can stream X in chunks for method
+
+        Otherwise (e.g. a Pipeline with a step without transform_chunks)
+        the model gets the whole memory-mapped X.
+        """
+        if not (self.args.mmap and hasattr(self.model, method + "_chunks")):
+            return False
+        if hasattr(self.model, "supports_chunks"):
+            return self.model.supports_chunks(method)
+        return True
+
+    def _X_chunks(self, merge_last=False):
+        return utils.iter_chunks(self.X, self.args.chunk_size, merge_last)
+
+    def _transform_chunks(self):
+        """Stream row chunks of X through the model into X_new
+
+        X_new is written to a memory-mapped X_new.npy in the save folder,
+        so neither X nor X_new is held in memory as a whole.
+        """
+        n_samples = self.X.shape[0]
+        X_new = None
+        start = 0
+
+        for X_new_chunk in self.model.transform_chunks(self._X_chunks()):
+            if sparse.issparse(X_new_chunk):
+                # sparse features are small, collect the chunks
+                X_new = [] if X_new is None else X_new
+                X_new.append(X_new_chunk)
+                continue
+
+            if X_new is None:
+                shape = (n_samples, X_new_chunk.shape[1])
+                if self.save_path is not None:
+                    X_new = np.lib.format.open_memmap(
+                        normpath(self.save_path+"X_new.npy"), mode="w+",
+                        dtype=X_new_chunk.dtype, shape=shape)
+                    self._X_new_saved = True
+                else:
+                    X_new = np.empty(shape, dtype=X_new_chunk.dtype)
+
+            stop = start + X_new_chunk.shape[0]
+            X_new[start:stop] = X_new_chunk
+            start = stop
+
+        if isinstance(X_new, list):
+            return sparse.vstack(X_new, format="csr")
+
+        if self._X_new_saved:
+            X_new.flush()
+
+        return X_new
+
+    def _save_X_new(self):
+        """Save X_new as X_new.npy, or X_new.npz if it is sparse"""
+        if sparse.issparse(self.X_new):
+            sparse.save_npz(normpath(self.save_path+"X_new.npz"), self.X_new)
+        else:
+            np.save(normpath(self.save_path+"X_new.npy"), self.X_new)
+
     def transform(self):
-        if "y" in getfullargspec(self.model.transform).args:
+        if self._chunked("transform"):
+            self.X_new = self._transform_chunks()
+        elif "y" in getfullargspec(self.model.transform).args:
             self.X_new = self.model.transform(self.X, self.y)
         else:
             self.X_new = self.model.transform(self.X)
@@ -97,7 +169,32 @@ class ConfigAction(Action):
         self.act()
 
     def fit(self):
-        self.model.fit(self.X, self.y)
+        # models whose fit reads X in chunks itself are not fitted with
+        # partial_fit on --chunk_size chunks
+        if self.args.mmap and hasattr(self.model, "partial_fit") and \
+                not getattr(self.model, "out_of_core_fit", False):
+            self._partial_fit()
+        else:
+            self.model.fit(self.X, self.y)
+
+    def _partial_fit(self):
+        """Fit the model chunk by chunk with partial_fit
+
+        Only one row chunk of the memory-mapped X is in memory at a time.
+        A short last chunk is joined to the one before, as some models
+        need a minimum number of rows per chunk. Classifiers get all
+        classes of y with every chunk.
+        """
+        fit_params = {}
+        if is_classifier(self.model):
+            fit_params["classes"] = np.unique(self.y)
+
+        start = 0
+        for X_chunk in self._X_chunks(merge_last=True):
+            stop = start + X_chunk.shape[0]
+            y_chunk = None if self.y is None else self.y[start:stop]
+            self.model.partial_fit(X_chunk, y_chunk, **fit_params)
+            start = stop
 
     def fit_transform(self):
         self.fit()
@@ -108,9 +205,8 @@ class ConfigAction(Action):
         joblib.dump(self.model,
                     normpath(self.save_path+class_name+".pkl"))
 
-        if self._X_new_set:
-            path = self.save_path+"X_new.npy"
-            np.save(normpath(path), self.X_new)
+        if self._X_new_set and not self._X_new_saved:
+            self._save_X_new()
 
     def _load_model(self):
         if "params" in self.config:
@@ -146,7 +242,11 @@ class ModelAction(Action):
         self.act()
 
     def predict(self):
-        self.y_new = self.model.predict(self.X)
+        if self._chunked("predict"):
+            self.y_new = np.concatenate(
+                list(self.model.predict_chunks(self._X_chunks())))
+        else:
+            self.y_new = self.model.predict(self.X)
         self._y_new_set = True
 
     def predict_proba(self):
@@ -158,9 +258,8 @@ class ModelAction(Action):
 
     def _save(self):
         y_path = normpath(self.save_path+"y_"+self.args.smt_label+".csv")
-        X_path = normpath(self.save_path+"X_new.npy")
-        if self._X_new_set:
-            np.save(X_path, self.X_new)
+        if self._X_new_set and not self._X_new_saved:
+            self._save_X_new()
         if self._y_new_set and self.args.action == "predict":
             df = pd.DataFrame({"Prediction": self.y_new})
             df.index += 1
@@ -196,7 +295,8 @@ if __name__ == '__main__':
     arg_parser.add_argument("-C", "--config", help="config file")
     arg_parser.add_argument("-M", "--model", help="model file")
 
-    arg_parser.add_argument("-X", help="Input data", required=True)
+    arg_parser.add_argument("-X", help="Input data (.npy, or .npz for "
+                                       "sparse features)", required=True)
     arg_parser.add_argument("-y", help="Input labels")
 
     arg_parser.add_argument("-a", "--action", choices=["transform", "predict",
@@ -204,6 +304,12 @@ if __name__ == '__main__':
                             help="Action to perform.",
                             required=True)
 
+    arg_parser.add_argument("--mmap", action="store_true",
+                            help="Memory-map X and stream it in row chunks "
+                                 "through models that support it.")
+    arg_parser.add_argument("--chunk_size", type=int, default=16,
+                            help="Rows per chunk in --mmap mode.")
+
     arg_parser.add_argument("smt_label", nargs="?", default="debug")
 
     args = arg_parser.parse_args()